@@ -217,12 +217,15 @@ class ImageDataProvider(Dataset):
         target_weight = target_weight if self.weight_suffix else np.ones_like(target_label)
         atlases_weight = atlases_weight if self.weight_suffix else np.ones_like(atlases_label)
 
-        return {'target_image': target_image,
-                'target_label': target_label,
-                'target_weight': target_weight,
-                'atlases_image': atlases_image,
-                'atlases_label': atlases_label,
-                'atlases_weight': atlases_weight,
+        # the one-hot atlases labels are passed as uint8 to cut the host-to-device copies, and cast on the device;
+        # the other arrays are pinned to the float32 of the network inputs, since rescaling, filtering and
+        # normalization may promote them to float64, which would otherwise be cast at every feed
+        return {'target_image': target_image.astype(np.float32, copy=False),
+                'target_label': target_label.astype(np.float32, copy=False),
+                'target_weight': target_weight.astype(np.float32, copy=False),
+                'atlases_image': atlases_image.astype(np.float32, copy=False),
+                'atlases_label': atlases_label.astype(np.uint8),
+                'atlases_weight': atlases_weight.astype(np.float32, copy=False),
                 'center_percent': center_percent}
 
     def __len__(self):
@@ -49,6 +49,28 @@ class DiceLoss(object):
 
         return tf.subtract(1., dice, name='dice_loss')
 
+    def multi_atlas_loss(self, target_prob, warped_atlases_prob):
+        """
+        Dice loss averaged over atlases, computed on the whole atlas axis at once.
+
+        :param target_prob: target probability map/one-hot label of shape [n_batch, *vol_shape, n_class]
+        :param warped_atlases_prob: atlases probability map of shape [n_batch, *vol_shape, n_atlas, n_class]
+        """
+        y_true = tf.expand_dims(target_prob, axis=-2)
+        y_pred = warped_atlases_prob
+
+        n_dims = y_pred.shape.ndims
+        if self.dice_type == 'multiclass':
+            axis = list(range(n_dims - 2))
+        elif self.dice_type == 'binary':
+            axis = list(range(n_dims - 2)) + [n_dims - 1]
+
+        numerator = 2 * tf.reduce_sum(y_true * y_pred, axis=axis)
+        denominator = tf.reduce_sum(y_true ** 2 + y_pred ** 2, axis=axis)
+        dice = tf.reduce_mean(numerator / tf.maximum(denominator, self.eps))
+
+        return tf.subtract(1., dice, name='multi_atlas_dice_loss')
+
     def multi_scale_loss(self, target_prob, warped_atlases_probs):
         """
         :param target_prob: target probability map of shape [n_batch, *vol_shape, n_class]
@@ -340,6 +362,17 @@ class CrossCorrelation(object):
     def loss(self, target, source):
         return tf.subtract(1., tf.reduce_mean(self.ncc(target, source)))
 
+    def multi_atlas_loss(self, target, atlases):
+        """
+        Cross correlation loss averaged over atlases, with the atlas axis folded into the batch axis.
+
+        :param target: target tensor of shape [n_batch, *vol_shape, 1]
+        :param atlases: atlases tensor of shape [n_batch, *vol_shape, n_atlas, 1]
+        """
+        n_atlas = atlases.get_shape().as_list()[-2]
+        target = tf.tile(tf.expand_dims(target, axis=-2), [1, 1, 1, n_atlas, 1])
+        return self.loss(utils_2d.merge_atlas_axis(target), utils_2d.merge_atlas_axis(atlases))
+
 
 class LocalDisplacementEnergy(object):
     """
@@ -372,6 +405,8 @@ class LocalDisplacementEnergy(object):
 
     def compute_displacement_energy(self, ddf, energy_weight):
         with tf.name_scope('displacement_energy'):
+            # the spatial gradients are cached along with their ddf, for reuse by the Jacobian determinants
+            self._ddf = ddf
             self._dTdx = self._gradient_txyz(ddf, self._gradient_dx)  # [batch, *vol_shape, 3]
             self._dTdy = self._gradient_txyz(ddf, self._gradient_dy)
             if energy_weight == 0:
@@ -405,9 +440,10 @@ class LocalDisplacementEnergy(object):
         :return: The Jacobian determinant of the vector fields of shape [batch, nx, ny, nz].
         """
         with tf.name_scope('jacobian_determinant'):
-            if not hasattr(self, '_dTdx'):
+            # only reuse the cached spatial gradients if they were computed on the same ddf
+            if getattr(self, '_ddf', None) is not ddf:
+                self._ddf = ddf
                 self._dTdx = self._gradient_txyz(ddf, self._gradient_dx)  # [batch, *vol_shape, 3]
-            if not hasattr(self, '_dTdy'):
                 self._dTdy = self._gradient_txyz(ddf, self._gradient_dy)
 
             jacobian_det = tf.subtract((self._dTdx[..., 0] + 1) * (self._dTdy[..., 1] + 1),
@@ -415,6 +451,25 @@ class LocalDisplacementEnergy(object):
                                        name='jacobian_det')
             return jacobian_det
 
+    def compute_negative_jacobian_number(self, ddf, n_atlas=1):
+        """
+        Count the voxels whose Jacobian determinants, averaged over atlases, are non-positive.
+
+        :param ddf: The displacement fields of shape [batch * n_atlas, nx, ny, 2], with the atlas axis merged into
+            the batch axis.
+        :param n_atlas: The number of atlases merged into the batch axis.
+        :return: The number of voxels of non-positive Jacobian determinants per sample, averaged over the batch.
+        """
+        with tf.name_scope('negative_jacobian_number'):
+            # the central differences crop the borders, so the determinants have their own spatial shape
+            jacobian_det = self.compute_jacobian_determinant(ddf)
+            det_shape = jacobian_det.get_shape().as_list()[1:]
+            if n_atlas > 1:
+                jacobian_det = tf.reduce_mean(tf.reshape(jacobian_det, [-1, n_atlas, *det_shape]), axis=1)
+            num_neg_jacob = tf.math.count_nonzero(tf.less_equal(jacobian_det, 0),
+                                                  axis=list(range(1, len(det_shape) + 1)), dtype=tf.int32)
+            return tf.reduce_mean(tf.cast(num_neg_jacob, tf.float32), name='negative_jacobian_voxels_per_sample')
+
 
 class MutualInformation(object):
     """
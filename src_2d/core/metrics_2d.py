@@ -156,6 +156,56 @@ class OverlapMetrics(object):
 
         return jaccard
 
+    def multi_atlas_averaged_foreground_jaccard(self, y_true, y_segs):
+        """
+        Averaged foreground Jaccard of each atlas, computed on the whole atlas axis at once by broadcasting the ground
+        truth, with the same reductions as averaged_foreground_jaccard.
+        Assume the first class is the background.
+
+        :param y_true: The ground truth of shape [n_batch, *vol_shape, n_class].
+        :param y_segs: The atlases segmentations of shape [n_batch, *vol_shape, n_atlas, n_class].
+        :return: The Jaccard of each atlas, of shape [n_atlas].
+        """
+        assert self.mode == 'tf', "Only the 'tf' mode is supported!"
+        assert y_segs.get_shape().as_list()[-1] == self.n_class, "The number of classes of the segmentation " \
+                                                                 "should be equal to %s!" % self.n_class
+        if self.one_hot:
+            y_segs = utils_2d.get_segmentation(y_segs, self.mode)
+        y_true = tf.expand_dims(tf.cast(y_true[..., 1:], dtype=tf.bool), axis=-2)
+        y_segs = tf.cast(y_segs[..., 1:], dtype=tf.bool)
+        # reduce over all axes but the atlas and class axes, of shape [n_atlas, n_class - 1]
+        axis = list(range(y_segs.shape.ndims - 2))
+        top = tf.reduce_sum(tf.cast(tf.logical_and(y_true, y_segs), tf.float32), axis=axis)
+        bottom = tf.reduce_sum(tf.cast(tf.logical_or(y_true, y_segs), tf.float32), axis=axis)
+        return tf.reduce_mean(top / tf.maximum(bottom, self.eps), axis=-1)
+
+    def foreground_dice_and_jaccard(self, y_true, y_seg):
+        """
+        Class-wise foreground Dice and Jaccard, computed together from a single intersection and a single sum of the
+        one-hot ground truth and segmentation, with the same reductions as averaged_foreground_dice and
+        averaged_foreground_jaccard.
+        Assume the first class is the background.
+
+        :param y_true: The one-hot ground truth of shape [n_batch, *vol_shape, n_class].
+        :param y_seg: The segmentation of shape [n_batch, *vol_shape, n_class].
+        :return: The Dice and the Jaccard of each foreground class, both of shape [n_class - 1].
+        """
+        assert self.mode == 'tf', "Only the 'tf' mode is supported!"
+        assert y_seg.get_shape().as_list()[-1] == self.n_class, "The number of classes of the segmentation " \
+                                                                "should be equal to %s!" % self.n_class
+        if self.one_hot:
+            y_seg = utils_2d.get_segmentation(y_seg, self.mode)
+        y_true = y_true[..., 1:]
+        y_seg = y_seg[..., 1:]
+        # reduce over all axes but the class axis
+        axis = list(range(y_seg.shape.ndims - 1))
+        intersection = tf.reduce_sum(y_true * y_seg, axis=axis)
+        total = tf.reduce_sum(y_true + y_seg, axis=axis)
+        dice = 2 * intersection / tf.maximum(total, self.eps)
+        # the union of binary masks is their total minus their intersection
+        jaccard = intersection / tf.maximum(total - intersection, self.eps)
+        return dice, jaccard
+
 
 class SurfaceDistance(object):
     """
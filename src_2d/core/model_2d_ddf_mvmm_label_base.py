@@ -8,10 +8,15 @@ The optimization is based on the multi-variate mixture model of the target image
 
 from __future__ import print_function, division, absolute_import, unicode_literals
 
+import collections
+import contextlib
+import itertools
 import math
 import os
 import random
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tensorflow.core.protobuf import rewriter_config_pb2
 from torch.utils.data import DataLoader
 
 from core.losses_2d import *
@@ -21,6 +26,10 @@ from core.networks_2d import *
 tfd = tf.distributions
 config = tf.ConfigProto(allow_soft_placement=True)
 config.gpu_options.allow_growth = True
+# explicitly turn on the Grappler passes that fold, fuse and prune the training graph
+for rewrite_option in ['arithmetic_optimization', 'layout_optimizer', 'remapping', 'constant_folding',
+                       'dependency_optimization']:
+    setattr(config.graph_options.rewrite_options, rewrite_option, rewriter_config_pb2.RewriterConfig.ON)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 
@@ -33,7 +42,8 @@ class UnifiedMultiAtlasSegNet(object):
     """
 
     def __init__(self, input_size: tuple = (64, 64), channels: int = 1, n_class: int = 2, n_atlas: int = 5,
-                 n_subtypes: tuple = (2, 1,), cost_kwargs=None, aug_kwargs=None, **net_kwargs, ):
+                 n_subtypes: tuple = (2, 1,), cost_kwargs=None, aug_kwargs=None, input_tensors=None, batch_size=None,
+                 **net_kwargs, ):
         """
         :param input_size: The input size for the network.
         :param channels: (Optional) number of channels in the input target image.
@@ -42,7 +52,11 @@ class UnifiedMultiAtlasSegNet(object):
         :param n_subtypes: A tuple indicating the number of subtypes within each tissue class, with the first element
             corresponding to the background subtypes.
         :param cost_kwargs: (Optional) kwargs passed to the cost function, e.g. regularizer_type/auxiliary_cost_name.
-        :param aug_kwargs: optional data augmentation arguments
+        :param aug_kwargs: optional data augmentation arguments, applied by the training input pipeline
+        :param input_tensors: (Optional) a dictionary of input tensors, e.g. from get_data_iterator(...).get_next(),
+            used as the defaults of the input placeholders so that no feed_dict is needed for the data
+        :param batch_size: (Optional) a fixed batch size, which specializes the graph to fully static shapes; the
+            batch size is left undetermined if not given
         :param net_kwargs: optional network configuration arguments
         """
         # assert n_class == len(n_subtypes), "The length of the subtypes tuple must equal to the number of classes."
@@ -60,12 +74,20 @@ class UnifiedMultiAtlasSegNet(object):
         self.cost_kwargs = cost_kwargs
         self.aug_kwargs = aug_kwargs
         self.cost_name = cost_kwargs.get('cost_name', None)
+        # resolve the loss builder of the designated cost once
+        self.loss_builder = self._get_loss_builders().get(self.cost_name)
+        if self.loss_builder is None:
+            raise NotImplementedError("Unknown cost function: %s" % self.cost_name)
         self.net_kwargs = net_kwargs
         self.prob_sigma = cost_kwargs.get('prob_sigma', (1, 2, 4, 8)) \
             if 'multi_scale' in self.cost_name else cost_kwargs.get('prob_sigma', (1,))
         self.prob_eps = cost_kwargs.get('prob_eps', math.exp(-3 ** 2 / 2))
+        self.prob_dtype = cost_kwargs.get('prob_dtype', 'float32')
+        self.jit_loss = cost_kwargs.get('jit_loss', False)
         self.logger = net_kwargs.get("logger", logging)
         self.summaries = net_kwargs.get("summaries", True)
+        # the settings string, built on the first call of __str__
+        self._str_cache = None
         # initialize regularizer
         self.regularizer_type = self.cost_kwargs.get("regularizer", None)
         self.net_regularizer = self.regularizer_type[0]
@@ -82,22 +104,20 @@ class UnifiedMultiAtlasSegNet(object):
             if prior_prob is None:
                 prior_prob =  tf.cast(tf.fill([1, 1, 1, n_class], 1 / self.n_class), dtype=tf.float32)
             self.pi = tf.reshape(prior_prob, shape=[1, 1, 1, n_class], name='prior_prob')
-            # input data
-            self.data = {'target_image': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], channels],
-                                                        name='target_image'),
-                         'target_label': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], n_class],
-                                                        name='target_label'),
-                         'target_weight': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], n_class],
-                                                         name='target_weight'),
-                         'atlases_image': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], n_atlas,
-                                                          channels], name='atlases_image'),
-                         'atlases_label': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], n_atlas, n_class],
-                                                         name='atlases_label'),
-                         'atlases_weight': tf.placeholder(tf.float32, [None, input_size[0], input_size[1], n_atlas, n_class],
-                                                          name='atlases_weight')
-                         }
-            # random affine data augmentation
-            self.augmented_data = self._get_augmented_data()
+            # input data, read from the input tensors if given, otherwise fed through feed_dict
+            data_shapes = get_data_shapes(input_size, channels, n_class, n_atlas, batch_size)
+            data_types = get_data_types()
+            if input_tensors is None:
+                self.data = {k: tf.placeholder(data_types[k], v, name=k) for k, v in data_shapes.items()}
+            else:
+                self.data = {k: tf.placeholder_with_default(input_tensors[k], v, name=k)
+                             for k, v in data_shapes.items()}
+            # upcast the quantized inputs on the device
+            self.input_data = {k: v if v.dtype == tf.float32 else tf.cast(v, tf.float32, name=k + '_float')
+                               for k, v in self.data.items()}
+            # the training data are augmented by the input pipeline (see get_data_iterator), so that no runtime
+            # switch on the training phase is needed and the validation/test graph carries no augmentation ops
+            self.augmented_data = self.input_data
 
         # with tf.name_scope('gmm_inputs'):
         #     self.tau = [tf.placeholder(tf.float32, [None, n_subtypes[i]], name='tau_subtype%s' % i)
@@ -131,17 +151,32 @@ class UnifiedMultiAtlasSegNet(object):
             else:
                 raise ValueError("Unknown method: %s" % self.net_kwargs['method'])
         
+        # the identity sampling grid, shared by the integration and the warping of atlases
+        self.identity_grid = tf.constant(utils_2d.get_reference_grid_numpy(input_size), dtype=tf.float32,
+                                         name='identity_grid')
+
         # integrate velocity fields by scaling and squaring
         if self.net_kwargs['diffeomorphism']:
             self.int_steps = self.net_kwargs.pop('int_steps', 8)
+            if self.int_steps < 0:
+                raise ValueError("The number of integration steps must be non-negative, got: %s" % self.int_steps)
             self.vec = self.ddf / (2**self.int_steps)
-            self.ddf = utils_2d.integrate_vec(self.vec, self.int_steps)
-        
-        with tf.variable_scope('loss'):
+            self.ddf = utils_2d.integrate_vec(self.vec, self.int_steps, grid=self.identity_grid)
+
+        # build the loss objects once, shared by the cost function and the score branch
+        self.dice_loss = DiceLoss()
+        self.cc_loss = CrossCorrelation()
+        self.ce_loss = CrossEntropy(eps=0.01, reduce_mean=False)
+        self.label_consistency_loss = LabelConsistencyLoss(**self.cost_kwargs)
+        self.mvmm_net_loss = MvMMNetLoss(**self.cost_kwargs)
+
+        # optionally compile the loss subgraph with XLA, which fuses its chains of element-wise ops
+        with tf.variable_scope('loss'), _maybe_jit_scope(self.jit_loss):
             # get target probability map, sigma is set to self.prob_sigma[0] (the finest scale) as default
             self.target_prob = utils_2d.get_prob_from_label(self.augmented_data['target_label'],
                                                             sigma=self.prob_sigma[0],
-                                                            eps=self.prob_eps)
+                                                            eps=self.prob_eps,
+                                                            dtype=self.prob_dtype)
 
 
             # get warped atlases probs/labels from each scale of ddf, each of shape [n_batch, *vol_shape, n_atlas, n_class]
@@ -152,18 +187,23 @@ class UnifiedMultiAtlasSegNet(object):
             self.warped_atlases_weight = self._get_warped_atlases(self.augmented_data['atlases_weight'],
                                                                   self.ddf, interp_method='linear')
 
-            # get warped atlases joint probability map of each scale, of shape [n_batch, *vol_shape, n_class]
-            self.atlases_joint_prob = [utils_2d.get_joint_prob(prob) for prob in self.warped_atlases_prob]
+            # bind the finest-scale warped atlases prob and its weighted version once, shared by the cost,
+            # the score branch, the segmenter and the prediction outputs
+            self.finest_atlases_prob = tf.identity(self.warped_atlases_prob[0], name='finest_atlases_prob')
+            self.weighted_atlases_prob = tf.multiply(self.finest_atlases_prob, self.warped_atlases_weight,
+                                                     name='weighted_atlases_prob')
+
+            # get warped atlases joint probability map of each scale, of shape [n_batch, *vol_shape, n_class],
+            # reduced over the atlas axis at once on the scale-stacked probs
+            self.atlases_joint_prob = tf.unstack(utils_2d.get_joint_prob(tf.stack(self.warped_atlases_prob, axis=0)),
+                                                 axis=0)
 
             # get loss function and joint distributions
             self.cost = self._get_cost(self.regularizer_type)
             self.pretrain_cost = self._get_pretrain_cost()
 
         # get segmentation
-        self.segmenter = utils_2d.get_segmentation(utils_2d.get_joint_prob(self.warped_atlases_prob[0]
-                                                                           * self.warped_atlases_weight
-                                                                           )
-                                                   )
+        self.segmenter = utils_2d.get_segmentation(utils_2d.get_joint_prob(self.weighted_atlases_prob))
 
         # get variables and update-ops
         self.trainable_variables = tf.trainable_variables(scope='network')
@@ -175,9 +215,6 @@ class UnifiedMultiAtlasSegNet(object):
         # self.ema = tf.train.ExponentialMovingAverage(decay=0.9999, num_updates=self.global_step)
         self.variables_to_restore = self.training_variables
 
-        # get gradients
-        self.gradients_node = tf.gradients(self.cost, self.trainable_variables, name='gradients')
-
         with tf.name_scope('metrics'):
             '''
             self.correct_pred = [tf.equal(tf.argmax(pred, -1), tf.argmax(self.target_labels, -1))
@@ -200,41 +237,58 @@ class UnifiedMultiAtlasSegNet(object):
                                                              num_thresholds=50,
                                                              name='auc') for pred in self.predictor])
             '''
-            self.average_dice = OverlapMetrics(n_class).averaged_foreground_dice(self.augmented_data['target_label'],
-                                                                                 self.segmenter)
-            self.myocardial_dice = OverlapMetrics(n_class).class_specific_dice(self.augmented_data['target_label'],
-                                                                               self.segmenter, i=1)
-            self.jaccard = OverlapMetrics(n_class).averaged_foreground_jaccard(self.augmented_data['target_label'],
-                                                                               self.segmenter)
-            self.ddfs_norm = tf.reduce_mean(tf.norm(self.ddf, axis=[1, 2]), name='ddfs_norm')
-
-    def _get_augmented_data(self, type=''):
-        """
-        Data augmentation using affine transformations.
-        :param type: type of augmentation
-        :return: The augmented data in training stage, whereas the original data in validation/test stage.
-        """
-        with tf.name_scope('augment_data'):
-            def true_fn():
-                augmented_data = dict(zip(['target_image', 'target_label', 'target_weight'],
-                                          random_affine_augment([self.data['target_image'], self.data['target_label'],
-                                                                 self.data['target_weight']],
-                                                                interp_methods=['linear', 'nearest', 'linear'],
-                                                                **self.aug_kwargs)))
-                # augmented_data.update(dict(zip(['atlases_image', 'atlases_label'], random_affine_augment([
-                # self.data['atlases_image'], self.data['atlases_label']], interp_methods=['linear', 'nearest'],
-                # **self.aug_kwargs))))
-                augmented_data.update(dict(zip(['atlases_image', 'atlases_label', 'atlases_weight'],
-                                               [self.data['atlases_image'], self.data['atlases_label'],
-                                                self.data['atlases_weight']])))
-                return augmented_data
-
-            return tf.cond(self.train_phase, true_fn, lambda: self.data)
+            # the averaged foreground Dice, the averaged foreground Jaccard and the myocardial Dice, stacked so that
+            # they are fetched as a single tensor
+            class_dice, class_jaccard = OverlapMetrics(n_class).foreground_dice_and_jaccard(
+                self.augmented_data['target_label'], self.segmenter)
+            self.overlap_metrics = tf.stack([tf.reduce_mean(class_dice), tf.reduce_mean(class_jaccard), class_dice[0]],
+                                            name='overlap_metrics')
+            self.average_dice, self.jaccard, self.myocardial_dice = tf.unstack(self.overlap_metrics)
+            # the Frobenius norms of the ddfs over the spatial axes, with the plain square-sum-sqrt op chain
+            self.ddfs_norm = tf.reduce_mean(tf.sqrt(tf.reduce_sum(tf.square(self.ddf), axis=[1, 2])), name='ddfs_norm')
 
     def _get_pretrain_cost(self):
         with tf.name_scope('pretrain_cost'):
             return tf.reduce_mean(self.ddf ** 2, name='pretrain_cost')
 
+    def _get_loss_builders(self):
+        """
+        Get the builders of the supported cost functions, each of which takes no arguments and returns the loss tensor.
+
+        :return: A dictionary of loss builders keyed by the cost names.
+        """
+        def mvmm_net_weight_loss():
+            return self.mvmm_net_loss.loss_weight(self.target_prob,
+                                                  self.finest_atlases_prob,
+                                                  self.augmented_data['target_weight'],
+                                                  self.warped_atlases_weight,
+                                                  self.pi)
+
+        def lncc_loss():
+            warped_atlases_image = self._get_warped_atlases(self.augmented_data['atlases_image'], self.ddf)
+            return self.cc_loss.multi_atlas_loss(self.augmented_data['target_image'], warped_atlases_image)
+
+        return {'label_consistency': lambda: self.label_consistency_loss.loss(self.target_prob,
+                                                                              self.atlases_joint_prob[0], self.pi),
+                'multi_scale_label_consistency': lambda: self.label_consistency_loss.multi_scale_loss(
+                    self.target_prob, self.atlases_joint_prob, self.pi),
+                # Dice loss between two probabilistic labels
+                'dice': lambda: self.dice_loss.multi_atlas_loss(self.target_prob, self.finest_atlases_prob),
+                'multi_scale_dice': lambda: self.dice_loss.multi_scale_loss(self.target_prob, self.atlases_joint_prob),
+                # class conditional probabilities over all atlases, of shape [n_batch, *vol_shape, n_class]
+                'cross_entropy': lambda: tf.reduce_mean(
+                    tf.nn.softmax_cross_entropy_with_logits_v2(labels=self.augmented_data['target_label'],
+                                                               logits=self.atlases_joint_prob[0]),
+                    name='cross_entropy'),
+                'SSD': lambda: tf.reduce_mean(tf.square(self.target_prob - self.atlases_joint_prob[0]), name='SSD'),
+                'LNCC': lncc_loss,
+                'L2_norm': lambda: tf.reduce_mean(tf.square(self.ddf)),
+                'mvmm_net_gmm': mvmm_net_weight_loss,
+                'mvmm_net_ncc': mvmm_net_weight_loss,
+                'mvmm_net_lecc': mvmm_net_weight_loss,
+                'mvmm_net_mask': lambda: self.mvmm_net_loss.loss_mask(self.target_prob, self.finest_atlases_prob,
+                                                                      self.pi)}
+
     def _get_cost(self, regularizer_type=None):
         """
         Constructs the cost function, Optional arguments are:
@@ -249,91 +303,17 @@ class UnifiedMultiAtlasSegNet(object):
         """
 
         with tf.name_scope('cost_function'):
-            if self.cost_name == 'mvmm':
-                raise NotImplementedError
-
-            elif self.cost_name == 'mvmm_mas':
-                raise NotImplementedError
-
-            elif self.cost_name == 'label_consistency':
-                loss = LabelConsistencyLoss(**self.cost_kwargs).loss(self.target_prob,
-                                                                     self.atlases_joint_prob[0],
-                                                                     self.pi)
-
-            elif self.cost_name == 'multi_scale_label_consistency':
-                loss = LabelConsistencyLoss(**self.cost_kwargs).multi_scale_loss(self.target_prob,
-                                                                                 self.atlases_joint_prob,
-                                                                                 self.pi)
-
-            elif self.cost_name == 'dice':
-                # Dice loss between two probabilistic labels
-                Dice = DiceLoss()
-                loss = tf.reduce_mean(tf.stack([Dice.loss(self.target_prob,
-                                                          self.warped_atlases_prob[0][..., i, :])
-                                                for i in range(self.n_atlas)]))
-
-            elif self.cost_name == 'multi_scale_dice':
-                loss = DiceLoss().multi_scale_loss(self.target_prob, self.atlases_joint_prob)
-
-            elif self.cost_name == 'cross_entropy':
-                # class conditional probabilities over all atlases, of shape [n_batch, *vol_shape, n_class]
-                loss = tf.reduce_mean(
-                    tf.nn.softmax_cross_entropy_with_logits_v2(labels=self.augmented_data['target_label'],
-                                                               logits=self.atlases_joint_prob[0]),
-                    name='cross_entropy')
-
-            elif self.cost_name == 'SSD':
-                loss = tf.reduce_mean(tf.square(self.target_prob - self.atlases_joint_prob[0]), name='SSD')
-
-            elif self.cost_name == 'LNCC':
-                warped_atlases_image = self._get_warped_atlases(self.augmented_data['atlases_image'], self.ddf)
-                loss = tf.reduce_mean(tf.stack([CrossCorrelation().loss(self.augmented_data['target_image'],
-                                                                        warped_atlases_image[..., i, :])
-                                                for i in range(self.n_atlas)]))
-
-            elif self.cost_name == 'KL_divergence':
-                raise NotImplementedError
-
-            elif self.cost_name == 'L2_norm':
-                loss = tf.reduce_mean(tf.square(self.ddf))
-
-            elif self.cost_name == 'mvmm_net_gmm':
-                loss = MvMMNetLoss(**self.cost_kwargs).loss_weight(self.target_prob,
-                                                                   self.warped_atlases_prob[0],
-                                                                   self.augmented_data['target_weight'],
-                                                                   self.warped_atlases_weight,
-                                                                   self.pi)
-
-            elif self.cost_name == 'mvmm_net_ncc':
-                loss = MvMMNetLoss(**self.cost_kwargs).loss_weight(self.target_prob,
-                                                                   self.warped_atlases_prob[0],
-                                                                   self.augmented_data['target_weight'],
-                                                                   self.warped_atlases_weight,
-                                                                   self.pi)
-
-            elif self.cost_name == 'mvmm_net_lecc':
-                loss = MvMMNetLoss(**self.cost_kwargs).loss_weight(self.target_prob,
-                                                                   self.warped_atlases_prob[0],
-                                                                   self.augmented_data['target_weight'],
-                                                                   self.warped_atlases_weight,
-                                                                   self.pi)
-
-            elif self.cost_name == 'mvmm_net_mask':
-                loss = MvMMNetLoss(**self.cost_kwargs).loss_mask(self.target_prob, self.warped_atlases_prob[0], self.pi)
-            else:
-                raise NotImplementedError
+            loss = self.loss_builder()
 
             if self.net_kwargs['method'] == 'ddf_score':
-                Jaccard = OverlapMetrics(n_class=self.n_class, one_hot=False, reduce_mean=False)
-                warped_atlases_jaccard = tf.stack([Jaccard.averaged_foreground_jaccard(self.augmented_data['target_label'],
-                                                                                       self.warped_atlases_prob[0][..., i, :])
-                                                   for i in range(self.n_atlas)], axis=-1)  # [n_batch, n_atlas]
-                CE = CrossEntropy(eps=0.01, reduce_mean=False)
-                warped_atlases_CE = tf.stack([tf.reduce_mean(tf.pow(x=CE.loss(y_true=self.augmented_data['target_label'],
-                                                                              y_pred=1-self.warped_atlases_prob[0][..., i, :]),
-                                                                    y=0.3),
-                                                             axis=(1, 2))
-                                              for i in range(self.n_atlas)], axis=-1)
+                # broadcast the target over the atlas axis instead of looping over the atlases
+                Jaccard = OverlapMetrics(n_class=self.n_class, one_hot=False)
+                warped_atlases_jaccard = Jaccard.multi_atlas_averaged_foreground_jaccard(
+                    self.augmented_data['target_label'], self.finest_atlases_prob)  # [n_atlas]
+                warped_atlases_CE = tf.reduce_mean(
+                    tf.pow(x=self.ce_loss.loss(y_true=tf.expand_dims(self.augmented_data['target_label'], axis=-2),
+                                               y_pred=1-self.finest_atlases_prob), y=0.3),
+                    axis=(1, 2))  # [n_batch, n_atlas]
                 self.scores_gt = warped_atlases_jaccard + warped_atlases_CE
 
                 self.scores_loss = tf.reduce_mean(tf.abs(tf.squeeze(self.scores, axis=-1)-self.scores_gt))
@@ -361,25 +341,45 @@ class UnifiedMultiAtlasSegNet(object):
             with each key-value pair denoting a probability map of a certain scale.
         """
         with tf.name_scope('warp_atlases_prob'):
-            spatial_transform = SpatialTransformer(interp_method, name='warp_atlases_prob')
+            spatial_transform = self._get_atlases_warper(interp_method, name='warp_atlases_prob')
             eps = kwargs.pop("eps", self.prob_eps)
 
-            warped_atlases_probs = []
-            for idx in range(len(self.prob_sigma)):
-                warped_atlases_probs.append(
-                    tf.stack([spatial_transform([utils_2d.get_prob_from_label(atlases_label[..., n, :],
-                                                                              self.prob_sigma[idx],
-                                                                              eps=eps),
-                                                 ddf[..., n, :]]) for n in range(self.n_atlas)], axis=-2))
+            # fold the atlas axis into the batch axis, of shape [n_batch * n_atlas, *vol_shape, n_class/2]
+            merged_label = utils_2d.merge_atlas_axis(atlases_label)
+            merged_ddf = utils_2d.merge_atlas_axis(ddf)
+
+            # blur the labels at all scales in one pass, and warp the probs of all scales at once as channels,
+            # of shape [n_batch * n_atlas, *vol_shape, n_class * n_scale]
+            n_scale = len(self.prob_sigma)
+            merged_prob = utils_2d.get_multi_scale_prob_from_label(merged_label, self.prob_sigma, eps=eps,
+                                                                   dtype=self.prob_dtype)
+            merged_prob = tf.reshape(merged_prob, [-1, *self.input_size, self.n_class * n_scale])
+            warped_prob = tf.reshape(spatial_transform([merged_prob, merged_ddf]),
+                                     [-1, *self.input_size, self.n_class, n_scale])
 
-            return warped_atlases_probs
+            return [utils_2d.split_atlas_axis(prob, self.n_atlas) for prob in tf.unstack(warped_prob, axis=-1)]
 
-    def _get_warped_atlases(self, atlases, ddf, **kwargs):
+    def _get_warped_atlases(self, atlases, ddf, interp_method='linear', **kwargs):
         with tf.name_scope('warp_atlases'):
-            spatial_transform = SpatialTransformer(name='warp_atlases', **kwargs)
-            warped_atlases = tf.stack([spatial_transform([atlases[..., i, :], ddf[..., i, :]])
-                                       for i in range(self.n_atlas)], axis=-2)
-            return warped_atlases
+            spatial_transform = self._get_atlases_warper(interp_method, name='warp_atlases', **kwargs)
+            # warp all atlases in a single call by folding the atlas axis into the batch axis
+            warped_atlases = spatial_transform([utils_2d.merge_atlas_axis(atlases), utils_2d.merge_atlas_axis(ddf)])
+            return utils_2d.split_atlas_axis(warped_atlases, self.n_atlas)
+
+    def _get_atlases_warper(self, interp_method='linear', **kwargs):
+        """
+        Get the function that warps the (atlas-merged) volumes with the dense displacement fields.
+
+        Linear warps resample the volumes at the shared identity grid plus the displacements by the native resampler
+        kernel, while other interpolation methods fall back to the SpatialTransformer layer.
+
+        :param interp_method: The interpolation method, should be either 'linear' or 'nearest'.
+        :param kwargs: optional arguments of the SpatialTransformer layer
+        :return: A callable taking a list of [volumes, ddf].
+        """
+        if interp_method == 'linear':
+            return lambda inputs: utils_2d.warp(inputs[0], inputs[1], grid=self.identity_grid)
+        return SpatialTransformer(interp_method, **kwargs)
 
     def save(self, saver, sess, model_path, **kwargs):
         """
@@ -402,14 +402,22 @@ class UnifiedMultiAtlasSegNet(object):
 
         :param sess: current session instance
         :param model_path: path to file system checkpoint location
+        :param saver: (Optional) an existing TensorFlow saver; otherwise a new one is built from the remaining kwargs
         """
 
-        saver = tf.train.Saver(**kwargs)
+        saver = kwargs.pop('saver', None)
+        if saver is None:
+            saver = tf.train.Saver(**kwargs)
         saver.restore(sess, model_path)
         self.logger.info("Model restored from file: %s" % model_path)
 
     def __str__(self):
         # Todo: to make the print more complete and pretty
+        if self._str_cache is None:
+            self._str_cache = self._format_settings()
+        return self._str_cache
+
+    def _format_settings(self):
         return "\n################ Network Parameter Settings ################\n" \
                "input_size= {}, num_channels= {}, num_classes= {}, num_atlases= {}, " \
                "num_subtypes= {}, \n" \
@@ -433,7 +441,7 @@ class NetForPrediction(UnifiedMultiAtlasSegNet):
     """
 
     def __init__(self, input_size=(64, 64, 64), channels=1, n_class=2, n_atlas=1, n_subtypes=(2, 1,), cost_kwargs=None,
-                 **net_kwargs):
+                 prefetch_device=None, **net_kwargs):
         """
         :param input_scale: The input scale for the network.
         :param test_input_size: The test input size.
@@ -444,34 +452,40 @@ class NetForPrediction(UnifiedMultiAtlasSegNet):
         :param n_subtypes: A tuple indicating the number of subtypes within each tissue class, with the first element
             corresponding to the background subtypes.
         :param cost_kwargs: (Optional) kwargs passed to the cost function, e.g. regularizer_type/auxiliary_cost_name.
+        :param prefetch_device: (Optional) the device to prefetch the test data to, e.g. '/gpu:0'.
         """
+        # test data to be consumed by the input pipeline, set by predict_scale
+        self._test_data = []
+        # the test data are predicted one by one, so the graph is specialized to a batch size of 1
+        self.data_iterator = get_data_iterator(lambda: iter(self._test_data), input_size, channels, n_class, n_atlas,
+                                               device=prefetch_device, batch_size=1)
 
         super(NetForPrediction, self).__init__(input_size, channels, n_class, n_atlas, n_subtypes,
-                                               cost_kwargs, **net_kwargs)
+                                               cost_kwargs, input_tensors=self.data_iterator.get_next(), batch_size=1,
+                                               **net_kwargs)
 
     def predict_scale(self, sess, test_data, dropout_rate):
         """
         Restore the model to make inference for the test data with resized dense displacement fields.
 
         :param sess: The session for predictions.
-        :param test_data: The test data for model inference.
+        :param test_data: The test data for model inference, or a list of test data to be predicted in a row, in which
+            case the next test data is prefetched by the input pipeline while the current one is being predicted.
         :param dropout_rate: dropout probability for network inference;
-        :return: image_pred - The predicted array representing the warped atlas images;
-                 label_pred - The predicted predictions representing the warped atlas labels;
-                 metrics - A dictionary combining list of various evaluation metrics.
+        :return: warped_atlases_prob - The warped atlases probability maps of the finest scale;
+                 warped_atlases_weight - The warped atlases weight maps;
+            or a list of such pairs if a list of test data is given.
         """
 
         self.logger.info("Start predicting warped test atlas!")
 
-        warped_atlases_prob, \
-        warped_atlases_weight = sess.run((self.warped_atlases_prob[0],
-                                          self.warped_atlases_weight),
-                                         feed_dict={self.data['target_image']: test_data['target_image'],
-                                                    self.data['atlases_image']: test_data['atlases_image'],
-                                                    self.data['atlases_label']: test_data['atlases_label'],
-                                                    self.data['atlases_weight']: test_data['atlases_weight'],
-                                                    self.dropout_rate: dropout_rate,
-                                                    self.train_phase: False})
+        single_data = isinstance(test_data, dict)
+        self._test_data = [test_data] if single_data else list(test_data)
+        sess.run(self.data_iterator.initializer)
+
+        predictions = [sess.run((self.finest_atlases_prob, self.warped_atlases_weight),
+                                feed_dict={self.dropout_rate: dropout_rate, self.train_phase: False})
+                       for _ in range(len(self._test_data))]
 
         # Overlap = OverlapMetrics(n_class=self.n_class, mode='np')
         # dice = Overlap.averaged_foreground_dice(y_true=test_data['target_label'], y_seg=label_pred)
@@ -492,7 +506,7 @@ class NetForPrediction(UnifiedMultiAtlasSegNet):
         #                  )
 
         # return label_pred, ddf, metrics
-        return warped_atlases_prob, warped_atlases_weight
+        return predictions[0] if single_data else predictions
 
 
 class Trainer(object):
@@ -501,7 +515,8 @@ class Trainer(object):
     """
 
     def __init__(self, net, batch_size=1, norm_grads=False, optimizer_name="momentum", learning_rate=0.001,
-                 num_workers=0, opt_kwargs=None):
+                 num_workers=0, opt_kwargs=None, data_iterator=None, jit_optimizer=False, lr_schedule='exponential',
+                 use_fp16=False):
         """
         :param net: The network instance to train.
         :param batch_size: The size of training batch.
@@ -511,6 +526,17 @@ class Trainer(object):
         :param num_workers: How many sub-processes to use for data loading.
             0 means that the data will be loaded in the main process. (default: 0)
         :param opt_kwargs: (Optional) kwargs passed to the learning rate (momentum opt) and to the optimizer.
+        :param data_iterator: (Optional) The initializable iterator of the training input pipeline, whose next elements
+            are the input tensors of the network, see get_data_iterator, with each batch repeated for the self
+            iterations of training; the training data are fed through feed_dict without augmentation if not given, so
+            it is required if the network asks for affine augmentation.
+        :param jit_optimizer: (Optional) true if the optimizer and the bending energy subgraphs should be compiled with
+            XLA, which fuses their many small element-wise ops.
+        :param lr_schedule: (Optional) the learning rate schedule of the momentum/sgd optimizers, either 'exponential'
+            (staircase exponential decay), 'piecewise' (the same staircase as a piecewise constant lookup) or 'cosine'
+            (cosine decay over all training steps).
+        :param use_fp16: (Optional) true if the training step should run in mixed precision, with float32 master
+            weights and dynamic loss scaling.
         """
         if opt_kwargs is None:
             opt_kwargs = {}
@@ -521,10 +547,53 @@ class Trainer(object):
         self.num_workers = num_workers
         self.opt_kwargs = opt_kwargs
         self.learning_rate = learning_rate
+        self.data_iterator = data_iterator
+        # the augmentation is only applied by the input pipeline, so the feed_dict path would silently skip it
+        if data_iterator is None and net.aug_kwargs and net.aug_kwargs.get('affine_augment', True):
+            raise ValueError("Data augmentation is requested by the network's aug_kwargs, which requires the "
+                             "data_iterator of an input pipeline built by get_data_iterator(..., aug_kwargs=...).")
+        self.jit_optimizer = jit_optimizer
+        self.lr_schedule = lr_schedule
+        self.use_fp16 = use_fp16
+        # the setups string, built on the first call of __str__ after _initialize
+        self._str_cache = None
+        # the run options of the session steps, with full tracing only for the profiled training steps
+        self._run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
+        self._trace_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        # the fed data names and their placeholders, followed by the dropout rate and the training phase
+        self._feed_names = ('target_image', 'target_label', 'target_weight',
+                            'atlases_label', 'atlases_image', 'atlases_weight')
+        self._feed_keys = tuple(self.net.data[k] for k in self._feed_names) + (self.net.dropout_rate,
+                                                                               self.net.train_phase)
+        self._val_cache = collections.OrderedDict()
+
+    def _get_jit_scope(self):
+        return _maybe_jit_scope(self.jit_optimizer)
+
+    def _get_learning_rate_node(self, init_lr, global_step, decay_steps, total_steps):
+        if self.lr_schedule == 'exponential':
+            return tf.train.exponential_decay(learning_rate=init_lr,
+                                              global_step=global_step,
+                                              decay_steps=decay_steps,
+                                              decay_rate=self.decay_rate,
+                                              staircase=True, name='learning_rate')
+        elif self.lr_schedule == 'piecewise':
+            # piecewise_constant switches to values[k + 1] once global_step > boundaries[k], so the boundaries are
+            # shifted by one step to decay at multiples of decay_steps as the staircase exponential decay does
+            boundaries = [step - 1 for step in range(decay_steps, total_steps, decay_steps)]
+            if not boundaries:
+                return tf.constant(init_lr, dtype=tf.float32, name='learning_rate')
+            values = [init_lr * self.decay_rate ** k for k in range(len(boundaries) + 1)]
+            return tf.train.piecewise_constant(global_step, boundaries, values, name='learning_rate')
+        elif self.lr_schedule == 'cosine':
+            return tf.train.cosine_decay(init_lr, global_step, decay_steps=total_steps, name='learning_rate')
+        else:
+            raise ValueError("Unknown learning rate schedule: %s" % self.lr_schedule)
 
     def _get_optimizer(self, cost, global_step, clip_gradient=False, **kwargs):
         optimizer_name = kwargs.pop('optimizer', self.optimizer_name)
         decay_steps = kwargs.pop('decay_step', 100000)
+        total_steps = kwargs.pop('total_steps', decay_steps)
         trainable_variables = self.net.trainable_variables
 
         # variables_to_average = trainable_variables + tf.moving_average_variables()
@@ -536,11 +605,7 @@ class Trainer(object):
             self.net.logger.info("SGD optimizer with initial lr: {:.2e}, momentum: {:.2f}, "
                                  "decay steps: {:d}, decay rate: {:.2f}".format(init_lr, momentum, decay_steps,
                                                                                 self.decay_rate))
-            learning_rate_node = tf.train.exponential_decay(learning_rate=init_lr,
-                                                            global_step=global_step,
-                                                            decay_steps=decay_steps,
-                                                            decay_rate=self.decay_rate,
-                                                            staircase=True, name='learning_rate')
+            learning_rate_node = self._get_learning_rate_node(init_lr, global_step, decay_steps, total_steps)
             optimizer = tf.train.MomentumOptimizer(learning_rate=learning_rate_node, momentum=momentum,
                                                    **self.opt_kwargs)
 
@@ -549,11 +614,7 @@ class Trainer(object):
             self.net.logger.info("SGD optimizer with initial lr: {:.2e}, "
                                  "decay steps: {:d}, decay rate: {:.2f}".format(init_lr, decay_steps,
                                                                                 self.decay_rate))
-            learning_rate_node = tf.train.exponential_decay(learning_rate=init_lr,
-                                                            global_step=global_step,
-                                                            decay_steps=decay_steps,
-                                                            decay_rate=self.decay_rate,
-                                                            staircase=True, name='learning_rate')
+            learning_rate_node = self._get_learning_rate_node(init_lr, global_step, decay_steps, total_steps)
             optimizer = tf.train.GradientDescentOptimizer(learning_rate=learning_rate_node, **self.opt_kwargs)
 
         elif optimizer_name == 'rmsprop':
@@ -590,51 +651,49 @@ class Trainer(object):
         else:
             raise ValueError("Unknown optimizer: %s" % optimizer_name)
 
-        if clip_gradient:
-            gradients, variables = zip(*optimizer.compute_gradients(cost, var_list=trainable_variables))
+        if self.use_fp16:
+            # the graph rewrite casts the convolutions to float16 while keeping the numerically sensitive ops, e.g.
+            # the reductions of the losses and bending energy, in float32
+            optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer, loss_scale='dynamic')
 
-            # clip by global norm
-            capped_grads, _ = tf.clip_by_global_norm(gradients, 1.0)
-            '''
-            # clip by individual norm
-            capped_grads = [None if grad is None else tf.clip_by_norm(grad, 1.0) for grad in gradients]
-            '''
-            opt_op = optimizer.apply_gradients(zip(capped_grads, variables), global_step=global_step)
-        else:
-            opt_op = optimizer.minimize(cost, global_step=global_step, var_list=trainable_variables)
+        # the gradients are built only here, and shared by the update and the monitored gradient norm; the variables
+        # without gradients are dropped
+        gradients, variables = zip(*[(grad, var) for grad, var in
+                                     optimizer.compute_gradients(cost, var_list=trainable_variables)
+                                     if grad is not None])
+        # the average of the per-variable gradient norms, reduced on device so that only a scalar is fetched
+        average_gradient_norm = tf.reduce_mean(tf.stack([tf.norm(g) for g in gradients]),
+                                               name='average_gradient_norm')
+
+        if clip_gradient:
+            # clip by global norm, whose value is monitored in the summaries
+            gradients, grad_global_norm = tf.clip_by_global_norm(gradients, kwargs.pop('clip_norm', 1.0))
+            tf.summary.scalar('grad_global_norm', grad_global_norm, collections=['train_summaries'])
+        opt_op = optimizer.apply_gradients(zip(gradients, variables), global_step=global_step)
 
-        train_op = tf.group([opt_op, self.net.update_ops])
+        # the moving statistics updates are grouped as a single dependency of the training op
+        with tf.control_dependencies([opt_op, tf.group(*self.net.update_ops, name='update_ops')]):
+            train_op = tf.no_op(name='train_op')
 
-        return optimizer, train_op, init_lr, learning_rate_node
+        return optimizer, train_op, init_lr, learning_rate_node, average_gradient_norm
 
     def _initialize(self, training_iters, self_iters, decay_epochs, epochs, clip_gradient, restore_model_path,
                     save_model_path, restore, prediction_path, pretrain_epochs):
         self.training_iters = training_iters
+        self._str_cache = None
         self.self_iters = self_iters
         self.decay_epochs = decay_epochs
         self.epochs = epochs
         opt_decay_steps = training_iters * self_iters * decay_epochs
 
         if self.net.summaries and self.norm_grads:
-            self.norm_gradients_node = tf.Variable(tf.constant(0.0, shape=[len(self.net.gradients_node)]),
+            self.norm_gradients_node = tf.Variable(tf.constant(0.0, shape=[len(self.net.trainable_variables)]),
                                                    name='norm_gradients')
             tf.summary.histogram('norm_grads', self.norm_gradients_node)
 
-        # create summary protocol buffers for training metrics
-        with tf.name_scope('Training_metrics_summaries'):
-            tf.summary.scalar('Training_Loss', tf.reduce_mean(self.net.cost))
-            #     tf.summary.scalar('Training_Accuracy', tf.reduce_mean(self.net.acc))
-            #     tf.summary.scalar('Training_AUC', tf.reduce_mean(self.net.auc))
-            #     tf.summary.scalar('Training_Sensitivity', tf.reduce_mean(self.net.sens))
-            #     tf.summary.scalar('Training_Specificity', tf.reduce_mean(self.net.spec))
-            tf.summary.scalar('Training_Average_Dice', self.net.average_dice)
-            tf.summary.scalar('Training_Myocardial_Dice', self.net.myocardial_dice)
-            tf.summary.scalar('Training_Jaccard', self.net.jaccard)
-            tf.summary.scalar('Training_DDFs_Norm', self.net.ddfs_norm)
-
         # add bending energy
         if self.net.regularizer_type[1] == 'bending_energy':
-            with tf.name_scope('bending_energy'):
+            with tf.name_scope('bending_energy'), self._get_jit_scope():
                 bending_energy_increment_rate = self.net.cost_kwargs.pop('bending_energy_increment_rate')
                 bending_energy_weight = tf.train.exponential_decay(self.net.regularization_coefficient[1],
                                                                    global_step=self.net.global_step,
@@ -642,38 +701,62 @@ class Trainer(object):
                                                                    decay_rate=bending_energy_increment_rate,
                                                                    staircase=True, name='bending_energy_weight')
                 BendingEnergy = LocalDisplacementEnergy(energy_type='bending')
-                bending_energy = tf.reduce_mean([BendingEnergy.compute_displacement_energy(self.net.ddf[..., i, :],
-                                                                                           bending_energy_weight)
-                                                 for i in range(self.net.n_atlas)])
+                # treat the atlas axis as batch, of shape [n_batch * n_atlas, *vol_shape, 2]
+                merged_ddf = utils_2d.merge_atlas_axis(self.net.ddf)
+                bending_energy = BendingEnergy.compute_displacement_energy(merged_ddf, bending_energy_weight)
                 setattr(self.net, 'bending_energy', bending_energy)
                 self.net.cost += bending_energy
 
-                jacobian_det = tf.reduce_mean([BendingEnergy.compute_jacobian_determinant(self.net.ddf[..., i, :])
-                                               for i in range(self.net.n_atlas)])
-                num_neg_jacob = tf.math.count_nonzero(tf.less_equal(jacobian_det, 0), dtype=tf.float32,
-                                                      name='negative_jacobians_number')
+                # number of voxels per sample whose Jacobian determinants averaged over atlases are non-positive,
+                # which reuses the spatial gradients of the ddfs computed for the bending energy
+                num_neg_jacob = BendingEnergy.compute_negative_jacobian_number(merged_ddf, self.net.n_atlas)
                 setattr(self.net, 'num_neg_jacob', num_neg_jacob)
 
+        # create summary protocol buffers for training metrics, on the same scalar nodes as the fetched statistics (the
+        # cost including the bending energy), so that each is evaluated only once per display step
+        with tf.name_scope('Training_metrics_summaries'):
+            tf.summary.scalar('Training_Loss', self.net.cost, collections=['train_summaries'])
+            #     tf.summary.scalar('Training_Accuracy', tf.reduce_mean(self.net.acc))
+            #     tf.summary.scalar('Training_AUC', tf.reduce_mean(self.net.auc))
+            #     tf.summary.scalar('Training_Sensitivity', tf.reduce_mean(self.net.sens))
+            #     tf.summary.scalar('Training_Specificity', tf.reduce_mean(self.net.spec))
+            tf.summary.scalar('Training_Average_Dice', self.net.average_dice, collections=['train_summaries'])
+            tf.summary.scalar('Training_Myocardial_Dice', self.net.myocardial_dice, collections=['train_summaries'])
+            tf.summary.scalar('Training_Jaccard', self.net.jaccard, collections=['train_summaries'])
+            tf.summary.scalar('Training_DDFs_Norm', self.net.ddfs_norm, collections=['train_summaries'])
+
         # initialize optimizer
-        with tf.name_scope('optimizer'):
+        with tf.name_scope('optimizer'), self._get_jit_scope():
             self.optimizer, self.train_op, \
-            self.init_lr, self.learning_rate_node = self._get_optimizer(self.net.cost, self.net.global_step,
-                                                                        clip_gradient, lr=self.learning_rate,
-                                                                        decay_steps=opt_decay_steps,
-                                                                        step_size=2 * training_iters * self_iters,
-                                                                        gamma=0.99998)
+            self.init_lr, self.learning_rate_node, \
+            self.average_gradient_norm = self._get_optimizer(self.net.cost, self.net.global_step,
+                                                             clip_gradient, lr=self.learning_rate,
+                                                             decay_steps=opt_decay_steps,
+                                                             total_steps=epochs * training_iters * self_iters,
+                                                             step_size=2 * training_iters * self_iters,
+                                                             gamma=0.99998)
             if pretrain_epochs:
                 _, self.pretrain_op, \
-                _, self.pretrain_lr = self._get_optimizer(self.net.pretrain_cost,
-                                                          global_step=tf.Variable(0, trainable=False, dtype=tf.int32),
-                                                          optimizer='adam', lr=1e-4)
+                _, self.pretrain_lr, _ = self._get_optimizer(self.net.pretrain_cost,
+                                                             global_step=tf.Variable(0, trainable=False, dtype=tf.int32),
+                                                             optimizer='adam', lr=1e-4)
+
+        # accumulate the epoch training loss on device, so that the loss need not be fetched at every step
+        with tf.name_scope('epoch_loss') as scope:
+            self.loss_mean, loss_mean_update = tf.metrics.mean(self.net.cost, name='mean')
+            self.reset_epoch_loss = tf.variables_initializer(
+                tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=scope), name='reset_epoch_loss')
+            with tf.control_dependencies([self.train_op, loss_mean_update]):
+                self.train_step_op = tf.no_op(name='train_step_op')
 
         # create a summary protocol buffer for learning rate
         with tf.name_scope('lr_summary'):
-            tf.summary.scalar('learning_rate', self.learning_rate_node)
+            tf.summary.scalar('learning_rate', self.learning_rate_node, collections=['train_summaries'])
 
-        # Merges summaries in the default graph
-        self.summary_op = tf.summary.merge_all()
+        # Merges the training scalars, which are written at every display step, apart from the remaining summaries in
+        # the default graph, i.e. the more expensive histograms, which are written at a rarer cadence
+        self.summary_op = tf.summary.merge(tf.get_collection('train_summaries'))
+        self.histogram_summary_op = tf.summary.merge_all()
 
         # create an op that initializes all training variables
         init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
@@ -724,17 +807,33 @@ class Trainer(object):
         :param restore_model_path: Where to restore the previous model.
         :param write_graph: Flag if the computation graph should be written as proto-buf file to the output path.
         :param prediction_path: The path where to save predictions on each epoch.
+        :param ddf_save_suffix: (Optional) The suffix of the displacement fields saved at validation, 'vector.nii' writes
+            them uncompressed.
+        :param histogram_step: (Optional) The number of steps till writing the histogram summaries, 10 display steps by
+            default.
+        :param profile_steps: (Optional) The training steps, counted over all epochs, whose first self iteration is
+            fully traced, with the run metadata written to the summaries for the TensorBoard timeline.
         """
         saver = tf.train.Saver(var_list=self.net.variables_to_restore, max_to_keep=kwargs.pop('max_to_keep', 5))
         best_saver = tf.train.Saver(var_list=self.net.variables_to_restore)
         save_path = os.path.join(save_model_path, "best_model.ckpt")
         # moving_average_path = os.path.join(save_model_path, "moving_average_model.ckpt")
 
-        # initialize data loader
-        train_data_loader = DataLoader(train_data_provider, batch_size=self.batch_size, shuffle=True,
-                                       num_workers=self.num_workers, collate_fn=train_data_provider.collate_fn)
-        # set default training iterations for every epoch and validation step
-        training_iters = len(train_data_loader)
+        if self.data_iterator is not None:
+            self._check_data_iterator(self_iters)
+        # initialize data loader, which is only needed for pre-training if the training data are read from the input
+        # pipeline, as the pre-training takes each batch once
+        if self.data_iterator is None or pretrain_epochs:
+            train_data_loader = DataLoader(train_data_provider, batch_size=self.batch_size, shuffle=True,
+                                           num_workers=self.num_workers, collate_fn=train_data_provider.collate_fn)
+        else:
+            train_data_loader = None
+        training_iters = math.ceil(len(train_data_provider) / self.batch_size)
+        ddf_save_suffix = kwargs.pop('ddf_save_suffix', 'vector.nii.gz')
+        # the histogram summaries are written at a rarer cadence than the other mini-batch statistics
+        histogram_step = kwargs.pop('histogram_step', 10 * display_step)
+        profile_steps = set(kwargs.pop('profile_steps', ()))
+        # set default validation step
         validation_step = kwargs.pop('validation_step', None)
         if validation_step is None:
             validation_step = training_iters
@@ -745,7 +844,13 @@ class Trainer(object):
                                 clip_gradient, restore_model_path, save_model_path,
                                 restore, prediction_path, pretrain_epochs)
 
-        with tf.Session(config=config) as sess:
+        session_config = tf.ConfigProto()
+        session_config.CopyFrom(config)
+        if self.jit_optimizer:
+            # let XLA also cluster the remaining compilable ops of the training step
+            session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+        with tf.Session(config=session_config) as sess:
             if write_graph:
                 tf.train.write_graph(sess.graph_def, save_model_path, "graph.pb", False)
 
@@ -757,16 +862,14 @@ class Trainer(object):
                 pretrain_steps = kwargs.pop('pretrain_steps', None)
                 if pretrain_steps is None:
                     pretrain_steps = pretrain_epochs * training_iters
-                pretrain_saver = tf.train.Saver(var_list=self.net.variables_to_restore)
                 pretrain_loss = 0.
                 self.net.logger.info("Start pre-training by minimizing L2-norm of dense displacement fields......")
+                # a single pass over the data loader, whose batches are fed over the input pipeline if any
                 for step, batch in enumerate(train_data_loader):
                     if step < pretrain_steps:
+                        feed_dict = self._get_data_feed_dict(batch, dropout, True)
                         _, loss, pretrain_lr = sess.run((self.pretrain_op, self.net.pretrain_cost, self.pretrain_lr),
-                                                        feed_dict={self.net.data['target_image']: batch['target_image'],
-                                                                   self.net.data['atlases_image']: batch['atlases_image'],
-                                                                   self.net.dropout_rate: dropout,
-                                                                   self.net.train_phase: True})
+                                                        feed_dict=feed_dict, options=self._run_options)
                         pretrain_loss += loss
 
                         if step % display_step == 0:
@@ -780,7 +883,7 @@ class Trainer(object):
                                      "Learning rate: %.2e" % (pretrain_loss / pretrain_steps,
                                                               pretrain_lr)
                                      )
-                self.net.save(pretrain_saver, sess, os.path.join(save_model_path, 'pretrain_model.ckpt'),
+                self.net.save(saver, sess, os.path.join(save_model_path, 'pretrain_model.ckpt'),
                               latest_filename='pretrain_checkpoint')
                 self.net.logger.info("Finish network pre-training!")
 
@@ -789,25 +892,27 @@ class Trainer(object):
                 self.net.logger.info("Restoring from model path: %s" % restore_model_path)
                 if '.ckpt' in restore_model_path:
                     self.net.logger.info("Restoring checkpoint: %s" % restore_model_path)
-                    new_saver = tf.train.import_meta_graph(restore_model_path)
-                    new_saver.restore(sess, restore_model_path, var_list=self.net.variables_to_restore)
+                    self.net.restore(sess, restore_model_path, saver=saver)
                 else:
                     ckpt = tf.train.get_checkpoint_state(restore_model_path,
                                                          latest_filename=kwargs.pop('latest_filename', None))
                     if ckpt and ckpt.model_checkpoint_path:
                         self.net.logger.info("Restoring checkpoint: %s" % ckpt.model_checkpoint_path)
-                        self.net.restore(sess, ckpt.model_checkpoint_path, var_list=self.net.variables_to_restore)
+                        self.net.restore(sess, ckpt.model_checkpoint_path, saver=saver)
                     else:
                         ckpt = tf.train.get_checkpoint_state(save_model_path,
                                                              latest_filename=kwargs.pop('latest_filename', None))
                         if ckpt and ckpt.model_checkpoint_path:
                             self.net.logger.info("Restoring checkpoint: %s" % ckpt.model_checkpoint_path)
-                            self.net.restore(sess, ckpt.model_checkpoint_path, var_list=self.net.variables_to_restore)
+                            self.net.restore(sess, ckpt.model_checkpoint_path, saver=saver)
                         else:
                             raise ValueError("Unknown previous model path: " % ckpt.model_checkpoint_path)
 
-            # create summary writer for training summaries
-            summary_writer = tf.summary.FileWriter(save_model_path, graph=sess.graph)
+            # create summary writers for training summaries, which queue the events and flush them in the background,
+            # the histograms are written apart so that they do not hold up the scalars
+            summary_writers = [tf.summary.FileWriter(save_model_path, graph=sess.graph, max_queue=1000, flush_secs=60),
+                               tf.summary.FileWriter(os.path.join(save_model_path, 'histograms'),
+                                                     max_queue=1000, flush_secs=60)]
 
             # create dictionary to record training/validation metrics for visualization
             test_metrics = {"Loss": {}, "Dice": {}, "Jaccard": {}, "Myocardial Dice": {},
@@ -830,14 +935,21 @@ class Trainer(object):
 
             lr = 0.
             assert self_iters >= 1
-            total_loss = 0.
             for epoch in range(epochs):
-                for step, batch in enumerate(train_data_loader):
+                if self.data_iterator is None:
+                    train_batches = train_data_loader
+                else:
+                    # the training batches only live in the input pipeline, which is restarted every epoch
+                    sess.run(self.data_iterator.initializer)
+                    train_batches = itertools.repeat(None, training_iters)
+
+                for step, batch in enumerate(train_batches):
                     # get validation metrics
                     if step % validation_step == 0:
                         epoch_test_metrics = self.store_prediction(sess, test_data_provider, validation_batch_size,
                                                                    dropout_rate=dropout,
-                                                                   save_dir='epoch%s_step%s' % (epoch, step))
+                                                                   save_dir='epoch%s_step%s' % (epoch, step),
+                                                                   ddf_save_suffix=ddf_save_suffix)
                         # save the current model if it is the best one hitherto
                         if (step > 0 or epoch > 0) and epoch_test_metrics['Dice'] >= np.max(list(test_metrics['Dice'].values())):
                             save_path = self.net.save(best_saver, sess, save_path, latest_filename='best_checkpoint')
@@ -852,29 +964,41 @@ class Trainer(object):
                                                    labels=['training', 'validation'])
 
                     # optimization operation (back-propagation)
+                    feed_dict = self._get_data_feed_dict(batch, dropout, True)
                     for self_step in range(self_iters):
-                        _, loss = sess.run((self.train_op, self.net.cost),
-                                           feed_dict={self.net.data['target_image']: batch['target_image'],
-                                                      self.net.data['target_label']: batch['target_label'],
-                                                      self.net.data['target_weight']: batch['target_weight'],
-                                                      self.net.data['atlases_label']: batch['atlases_label'],
-                                                      self.net.data['atlases_image']: batch['atlases_image'],
-                                                      self.net.data['atlases_weight']: batch['atlases_weight'],
-                                                      self.net.dropout_rate: dropout,
-                                                      self.net.train_phase: True})
-                        total_loss += loss
+                        fetch_stats = step % display_step == 0 and self_step == self_iters - 1
+                        if fetch_stats:
+                            # fetch the mini-batch statistics along with the last self iteration, which saves a
+                            # second forward pass (and the batch cannot be fed again from the input pipeline)
+                            fetches = (self.train_step_op, self._get_minibatch_stats_fetches(
+                                with_histograms=step % histogram_step == 0))
+                        else:
+                            fetches = self.train_step_op
+
+                        if self_step == 0 and epoch * training_iters + step in profile_steps:
+                            run_metadata = tf.RunMetadata()
+                            results = sess.run(fetches, feed_dict=feed_dict, options=self._trace_options,
+                                               run_metadata=run_metadata)
+                            summary_writers[0].add_run_metadata(run_metadata, 'epoch%s_step%s' % (epoch, step))
+                        else:
+                            results = sess.run(fetches, feed_dict=feed_dict, options=self._run_options)
+
+                        if fetch_stats:
+                            _, stats = results
 
                     # display mini-batch statistics and record training metrics
                     if step % display_step == 0:
                         # get training metrics for the display step
-                        step_train_metrics, grads, lr = self.output_minibatch_stats(sess, summary_writer, epoch, step,
-                                                                                    batch, dropout_rate=dropout)
+                        step_train_metrics, lr = self.output_minibatch_stats(summary_writers, epoch, step, stats)
                         # record training losses
                         for k, v in train_metrics.items():
                             v[epoch * training_iters * self_iters + (step + 1) * self_iters] = step_train_metrics[k]
 
                 # display epoch statistics
-                self.output_epoch_stats(epoch, total_loss, (epoch + 1) * training_iters * self_iters, lr)
+                self.output_epoch_stats(epoch, sess.run(self.loss_mean), lr)
+                sess.run(self.reset_epoch_loss)
+                for summary_writer in summary_writers:
+                    summary_writer.flush()
 
                 # save the current model
                 self.net.save(saver, sess, os.path.join(save_model_path, 'epoch%s_model.ckpt' % epoch),
@@ -882,6 +1006,8 @@ class Trainer(object):
                 # self.net.save(sess, moving_average_path, latest_filename='moving_average_checkpoint')
 
             self.net.logger.info("Optimization Finished!")
+            for summary_writer in summary_writers:
+                summary_writer.close()
             self.net.save(saver, sess, os.path.join(save_model_path, 'checkpoint.ckpt'))
 
             return save_path, train_metrics, test_metrics
@@ -895,72 +1021,89 @@ class Trainer(object):
         :param validation_batch_size: The validation data size.
         :param dropout_rate: The dropout probability.
         :param save_prefix: The save prefix for results saving.
+        :param ddf_save_suffix: The suffix of the saved displacement fields, 'vector.nii' skips the gzip compression.
         :return: A dictionary containing validation metrics.
         """
         save_prefix = kwargs.pop('save_prefix', '')
         save_dir = kwargs.pop('save_dir', '')
-        sess.run(tf.local_variables_initializer())
+        ddf_save_suffix = kwargs.pop('ddf_save_suffix', 'vector.nii.gz')
         if validation_batch_size is not None:
             # randomly sample the validation data at each epoch
             data_indices = random.sample(range(len(test_data_provider)), validation_batch_size)
         else:
             validation_batch_size = len(test_data_provider)
             data_indices = range(validation_batch_size)
-        loss = np.zeros([validation_batch_size])
-        dice = np.zeros([validation_batch_size])
-        jaccard = np.zeros([validation_batch_size])
-        myo_dice = np.zeros([validation_batch_size])
-        ddfs_norm = np.zeros([validation_batch_size])
-        bending_energy = np.zeros([validation_batch_size])
-        num_neg_jacob = np.zeros([validation_batch_size])
-        scores_loss = np.zeros([validation_batch_size])
-        for i in range(validation_batch_size):
-            data = test_data_provider[data_indices[i]]
-            loss[i], dice[i], jaccard[i], myo_dice[i], ddfs_norm[i], bending_energy[i], \
-                num_neg_jacob[i], scores_loss[i], \
-                test_pred, ddf = sess.run((self.net.cost, self.net.average_dice, self.net.jaccard,
-                                            self.net.myocardial_dice, self.net.ddfs_norm,
-                                            self.net.bending_energy, self.net.num_neg_jacob, self.net.scores_loss,
-                                            self.net.segmenter, self.net.ddf),
-                                           feed_dict={self.net.data['target_image']: data['target_image'],
-                                                      self.net.data['target_label']: data['target_label'],
-                                                      self.net.data['target_weight']: data['target_weight'],
-                                                      self.net.data['atlases_label']: data['atlases_label'],
-                                                      self.net.data['atlases_image']: data['atlases_image'],
-                                                      self.net.data['atlases_weight']: data['atlases_weight'],
-                                                      # self.net.pi: test_pi[i],
-                                                      self.net.train_phase: False,
-                                                      self.net.dropout_rate: dropout_rate})
-
-            utils_2d.save_prediction_png(data['target_image'], data['target_label'], test_pred,
-                                         os.path.join(self.prediction_path, save_dir), name_index=data_indices[i],
-                                         data_provider=test_data_provider, save_prefix=save_prefix)
-
-            # utils.save_prediction_nii(test_pred.squeeze(0), self.prediction_path, test_data_provider,
-            #                           name_index=data_indices[i], data_type='label', affine=data['target_affine'],
-            #                           header=data['target_header'], save_prefix=save_prefix)
-
-            target_name, atlases_name = test_data_provider.get_image_names(data_indices[i])
-            for k in range(self.net.n_atlas):
-                t_name = '_'.join(os.path.basename(target_name).split('_')[0:3])
-                a_name = '_'.join(os.path.basename(atlases_name[k]).split('_')[0:3])
-                save_name = 'target-' + t_name + '_atlas-' + a_name
-                utils_2d.save_prediction_nii(ddf[0, ..., k, :], os.path.join(self.prediction_path, save_dir),
-                                             test_data_provider, save_name=save_name, data_type='vector_fields',
-                                             save_prefix=save_prefix)
+        # batch-averaged scalars and their batch sizes, and the overlap metrics of each sample
+        batch_stats, batch_sizes = [], []
+        dice, jaccard, myo_dice = [], [], []
+        metrics_np = OverlapMetrics(self.net.n_class, mode='np')
+        # create the save directory once, before the writer threads race to create it
+        save_path = os.path.join(self.prediction_path, save_dir)
+        os.makedirs(save_path, exist_ok=True)
+        # write the predictions from a thread pool, so that the disk I/O overlaps with the next sess.run
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = []
+            # run the validation data in mini-batches of the training batch size, with one sess.run for each
+            for begin in range(0, validation_batch_size, self.batch_size):
+                end = min(begin + self.batch_size, validation_batch_size)
+                data = test_data_provider.collate_fn([self._get_validation_sample(test_data_provider, data_indices[i],
+                                                                                  2 * validation_batch_size)
+                                                      for i in range(begin, end)])
+                feed_dict = self._get_data_feed_dict(data, dropout_rate, False)
+                loss, ddfs_norm, bending_energy, num_neg_jacob, scores_loss, \
+                    test_pred, ddf = sess.run((self.net.cost, self.net.ddfs_norm,
+                                               self.net.bending_energy, self.net.num_neg_jacob, self.net.scores_loss,
+                                               self.net.segmenter, self.net.ddf), feed_dict=feed_dict,
+                                              options=self._run_options)
+                # the number of negative Jacobian voxels is already averaged over the mini-batch
+                batch_stats.append((loss, ddfs_norm, bending_energy, num_neg_jacob, scores_loss))
+                batch_sizes.append(end - begin)
+
+                for j, i in enumerate(range(begin, end)):
+                    # overlap metrics of each sample, computed from the batched predictions
+                    dice.append(metrics_np.averaged_foreground_dice(data['target_label'][j:j + 1], test_pred[j:j + 1]))
+                    jaccard.append(metrics_np.averaged_foreground_jaccard(data['target_label'][j:j + 1],
+                                                                          test_pred[j:j + 1]))
+                    myo_dice.append(metrics_np.class_specific_dice(data['target_label'][j:j + 1], test_pred[j:j + 1],
+                                                                   i=1))
+
+                    futures.append(pool.submit(utils_2d.save_prediction_png,
+                                               data['target_image'][j:j + 1].copy(),
+                                               data['target_label'][j:j + 1].copy(),
+                                               test_pred[j:j + 1].copy(), save_path,
+                                               name_index=data_indices[i], data_provider=test_data_provider,
+                                               save_prefix=save_prefix))
+
+                    # utils.save_prediction_nii(test_pred.squeeze(0), self.prediction_path, test_data_provider,
+                    #                           name_index=data_indices[i], data_type='label',
+                    #                           affine=data['target_affine'], header=data['target_header'],
+                    #                           save_prefix=save_prefix)
+
+                    target_name, atlases_name = test_data_provider.get_image_names(data_indices[i])
+                    t_name = '_'.join(os.path.basename(target_name).split('_')[0:3])
+                    save_names = ['target-' + t_name + '_atlas-' + '_'.join(os.path.basename(a_name).split('_')[0:3])
+                                  for a_name in atlases_name]
+                    futures.append(pool.submit(utils_2d.save_ddfs_nii, ddf[j].copy(), save_path, save_names,
+                                               save_prefix=save_prefix, save_suffix=ddf_save_suffix))
+
+            # wait for the writes to finish and re-raise any of their exceptions
+            for f in futures:
+                f.result()
 
         '''
         acc, auc, sens, spec = sess.run([self.net.acc[0], self.net.auc[0], self.net.sens[0], self.net.spec[0]])
         '''
-        metrics = {'Loss': np.mean(loss), 'DDFs norm': np.mean(ddfs_norm), 'Dice': np.mean(dice),
+        loss, ddfs_norm, bending_energy, num_neg_jacob, scores_loss = np.average(np.asarray(batch_stats), axis=0,
+                                                                                 weights=batch_sizes)
+        metrics = {'Loss': loss, 'DDFs norm': ddfs_norm, 'Dice': np.mean(dice),
                    'Jaccard': np.mean(jaccard), 'Myocardial Dice': np.mean(myo_dice),
-                   'Bending energy': np.mean(bending_energy), '# Negative Jacobians': np.mean(num_neg_jacob)}
+                   'Bending energy': bending_energy, '# Negative Jacobians': num_neg_jacob}
 
         self.net.logger.info("[Validation] Loss= {:.4f}, Scores loss={:.4f}, DDFs norm= {:.4f}, "
                              "Bending energy= {:.4f}, # Negative Jacobians= {:.1f}, "
                              "Dice= {:.4f}, Jaccard= {:.4f}, "
                              "Myocardial Dice= {:.4f}".format(metrics['Loss'],
-                                                              np.mean(scores_loss),
+                                                              scores_loss,
                                                               metrics['DDFs norm'],
                                                               metrics['Bending energy'],
                                                               metrics['# Negative Jacobians'],
@@ -970,58 +1113,115 @@ class Trainer(object):
 
         return metrics
 
-    def output_epoch_stats(self, epoch, total_loss, training_iters, lr):
+    def _get_validation_sample(self, test_data_provider, index, max_size):
+        """
+        Load a validation sample, memoized across validations unless the data-provider crops or augments randomly.
+
+        :param test_data_provider: The test data-provider.
+        :param index: The sample index.
+        :param max_size: The maximum number of cached samples, beyond which the oldest ones are dropped.
+        :return: The sample of the data-provider.
+        """
+        if getattr(test_data_provider, 'random_crop', False) or getattr(test_data_provider, 'image_augmentation', False):
+            return test_data_provider[index]
+
+        key = (id(test_data_provider), index)
+        if key in self._val_cache:
+            self._val_cache.move_to_end(key)
+        else:
+            self._val_cache[key] = test_data_provider[index]
+            while len(self._val_cache) > max_size:
+                self._val_cache.popitem(last=False)
+        return self._val_cache[key]
+
+    def output_epoch_stats(self, epoch, mean_loss, lr):
         self.net.logger.info(
             "[Training] Epoch {:}, Average Loss: {:.4f}, "
-            "learning rate: {:.1e}".format(epoch, (total_loss / training_iters), lr))
+            "learning rate: {:.1e}".format(epoch, mean_loss, lr))
+
+    def _check_data_iterator(self, self_iters):
+        """
+        Check that the network inputs are read from the input pipeline, with each batch repeated for the self
+        iterations, since every self iteration consumes one element of the pipeline.
+
+        :param self_iters: The number of self iterations.
+        """
+        repeats = getattr(self.data_iterator, 'repeats', None)
+        if repeats != self_iters:
+            raise ValueError("The data_iterator repeats each batch %s times, but the number of self iterations is %s; "
+                             "build it with get_data_iterator(..., repeats=self_iters)." % (repeats, self_iters))
+        iterator_resource = self.data_iterator._iterator_resource.name
+        for k, v in self.net.data.items():
+            source = v.op.inputs[0].op if v.op.inputs else None
+            if source is None or source.type != 'IteratorGetNext' or source.inputs[0].name != iterator_resource:
+                raise ValueError("The network input '%s' is not read from the data_iterator, build the network with "
+                                 "input_tensors=data_iterator.get_next()." % k)
+
+    def _get_data_feed_dict(self, batch, dropout_rate, train_phase):
+        """
+        Get the feed dictionary of the network inputs.
 
-    def output_minibatch_stats(self, sess, summary_writer, epoch, step, batch, dropout_rate):
-        # Calculate batch loss and metrics
-        sess.run(tf.local_variables_initializer())
+        :param batch: A dictionary of the data arrays, or None if the data come from the input pipeline.
+        :param dropout_rate: The dropout probability.
+        :param train_phase: Whether in the training phase.
+        :return: The feed dictionary, with only the dropout rate and the training phase if batch is None.
+        """
+        if batch is None:
+            return dict(zip(self._feed_keys[-2:], (dropout_rate, train_phase)))
+        return dict(zip(self._feed_keys, tuple(batch[k] for k in self._feed_names) + (dropout_rate, train_phase)))
+
+    def _get_minibatch_stats_fetches(self, with_histograms=False):
+        summary_ops = [self.summary_op]
+        if with_histograms and self.histogram_summary_op is not None:
+            summary_ops.append(self.histogram_summary_op)
+        return (summary_ops, self.net.cost, self.learning_rate_node, self.average_gradient_norm,
+                self.net.overlap_metrics,
+                self.net.ddfs_norm, self.net.bending_energy,
+                self.net.scores_loss, self.net.num_neg_jacob)
+
+    def output_minibatch_stats(self, summary_writers, epoch, step, stats):
+        """
+        Log the mini-batch statistics.
 
-        summary_str, \
-        loss, lr, grads, \
-        dice, jaccard, myo_dice, \
+        :param summary_writers: The summary writers of the training scalars and of the histograms, respectively.
+        :param stats: The results of the fetches from _get_minibatch_stats_fetches, run along with the training step.
+        """
+        summary_strs, \
+        loss, lr, grad_norm, \
+        (dice, jaccard, myo_dice), \
         ddfs_norm, bending_energy, scores_loss, \
-        num_neg_jacob = sess.run((self.summary_op, self.net.cost, self.learning_rate_node, self.net.gradients_node,
-                                  self.net.average_dice, self.net.jaccard, self.net.myocardial_dice,
-                                  self.net.ddfs_norm, self.net.bending_energy,
-                                  self.net.scores_loss, self.net.num_neg_jacob),
-                                 feed_dict={self.net.data['target_image']: batch['target_image'],
-                                            self.net.data['target_label']: batch['target_label'],
-                                            self.net.data['target_weight']: batch['target_weight'],
-                                            self.net.data['atlases_label']: batch['atlases_label'],
-                                            self.net.data['atlases_image']: batch['atlases_image'],
-                                            self.net.data['atlases_weight']: batch['atlases_weight'],
-                                            # self.net.pi: batch_pi,
-                                            self.net.train_phase: False,
-                                            self.net.dropout_rate: dropout_rate})
-        summary_writer.add_summary(summary_str, step)
-        summary_writer.flush()
+        num_neg_jacob = stats
+        for summary_writer, summary_str in zip(summary_writers, summary_strs):
+            summary_writer.add_summary(summary_str, step)
 
         metrics = {'Loss': loss, 'DDFs norm': ddfs_norm, 'Dice': dice, 'Jaccard': jaccard,
                    'Myocardial Dice': myo_dice, "Bending energy": bending_energy,
                    "# Negative Jacobians": num_neg_jacob,
-                   'Average gradient norm': np.mean([np.linalg.norm(g) for g in grads])}
-
-        self.net.logger.info("[Training] Epoch {:}, Iteration {:}, Mini-batch Loss= {:.4f}, "
-                             "Mini-batch Scores loss= {:.4f}, "
-                             "Learning rate= {:.3e}, DDFs norm= {:.4f}, Bending energy= {:.4f}, "
-                             "# Negative Jacobians= {:.1f}, Average gradient norm {:.4f}, "
-                             "Average foreground Dice= {:.4f}, "
-                             "Myocardial Dice= {:.4f}".format(epoch, step, metrics['Loss'],
-                                                              scores_loss,
-                                                              lr, metrics['DDFs norm'],
-                                                              metrics['Bending energy'],
-                                                              metrics['# Negative Jacobians'],
-                                                              metrics['Average gradient norm'],
-                                                              metrics['Dice'], metrics['Myocardial Dice'])
-                             )
-
-        return metrics, grads, lr
+                   'Average gradient norm': grad_norm}
+
+        # lazily formatted, so that the string is not built if INFO records are filtered
+        self.net.logger.info("[Training] Epoch %d, Iteration %d, Mini-batch Loss= %.4f, "
+                             "Mini-batch Scores loss= %.4f, "
+                             "Learning rate= %.3e, DDFs norm= %.4f, Bending energy= %.4f, "
+                             "# Negative Jacobians= %.1f, Average gradient norm %.4f, "
+                             "Average foreground Dice= %.4f, "
+                             "Myocardial Dice= %.4f", epoch, step, metrics['Loss'],
+                             scores_loss,
+                             lr, metrics['DDFs norm'],
+                             metrics['Bending energy'],
+                             metrics['# Negative Jacobians'],
+                             metrics['Average gradient norm'],
+                             metrics['Dice'], metrics['Myocardial Dice'])
+
+        return metrics, lr
 
     def __str__(self):
         # Todo: to make the print more complete
+        if self._str_cache is None:
+            self._str_cache = self._format_setups()
+        return self._str_cache
+
+    def _format_setups(self):
         return str(self.net) + '\n' \
                                "################ Training Setups ################\n" \
                                "batch_size= {}, optimizer_name= {}, num_workers= {}, \n" \
@@ -1041,7 +1241,99 @@ class Trainer(object):
 # Helper functions
 #####################################################################
 
-def _compute_gradients(tensor, var_list):
-    grads = tf.gradients(tensor, var_list)
-    return [grad if grad is not None else tf.zeros_like(var)
-            for var, grad in zip(var_list, grads)]
+def get_data_shapes(input_size, channels, n_class, n_atlas, batch_size=None):
+    """
+    Get the shapes of the input data.
+
+    :param batch_size: (Optional) the fixed batch size, left undetermined if not given.
+    :return: A dictionary of tensor shapes keyed by the data names.
+    """
+    return {'target_image': [batch_size, input_size[0], input_size[1], channels],
+            'target_label': [batch_size, input_size[0], input_size[1], n_class],
+            'target_weight': [batch_size, input_size[0], input_size[1], n_class],
+            'atlases_image': [batch_size, input_size[0], input_size[1], n_atlas, channels],
+            'atlases_label': [batch_size, input_size[0], input_size[1], n_atlas, n_class],
+            'atlases_weight': [batch_size, input_size[0], input_size[1], n_atlas, n_class]}
+
+
+def get_data_types():
+    """
+    Get the types of the input data, where the one-hot atlases labels are quantized to uint8.
+
+    :return: A dictionary of tensor types keyed by the data names.
+    """
+    return {'target_image': tf.float32,
+            'target_label': tf.float32,
+            'target_weight': tf.float32,
+            'atlases_image': tf.float32,
+            'atlases_label': tf.uint8,
+            'atlases_weight': tf.float32}
+
+
+def augment_data(data, **aug_kwargs):
+    """
+    Augment the target data using random affine transformations, leaving the atlases data unchanged.
+
+    :param data: A dictionary of data tensors.
+    :param aug_kwargs: optional arguments transferred to random_affine_augment
+    :return: A dictionary of the augmented data tensors.
+    """
+    augmented_data = dict(data)
+    augmented_data.update(zip(['target_image', 'target_label', 'target_weight'],
+                              random_affine_augment([data['target_image'], data['target_label'], data['target_weight']],
+                                                    interp_methods=['linear', 'nearest', 'linear'], **aug_kwargs)))
+    # augmented_data.update(dict(zip(['atlases_image', 'atlases_label'], random_affine_augment([
+    # data['atlases_image'], data['atlases_label']], interp_methods=['linear', 'nearest'], **aug_kwargs))))
+    return augmented_data
+
+
+def get_data_iterator(generator, input_size, channels, n_class, n_atlas, device=None, buffer_size=2, aug_kwargs=None,
+                      repeats=1, batch_size=None):
+    """
+    Build an initializable iterator of a tf.data input pipeline, which prefetches the data in a background thread so
+    that host-to-device copies overlap with the computation.
+
+    :param generator: A callable returning an iterable of (collated) data dictionaries, e.g. a data loader.
+    :param device: (Optional) the device to prefetch the data to, e.g. '/gpu:0'; the data are prefetched into host
+        memory if not given.
+    :param buffer_size: The number of batches to prefetch.
+    :param aug_kwargs: (Optional) data augmentation arguments; if given, the data are augmented by affine
+        transformations on the CPU with parallel calls, overlapping with the network computation.
+    :param repeats: The number of times each batch is repeated, e.g. for the self iterations of training, where each
+        repetition is augmented independently.
+    :param batch_size: (Optional) the fixed batch size of the data, left undetermined if not given.
+    :return: The iterator, whose get_next() gives a dictionary of tensors that can be passed as the input tensors of
+        the network.
+    """
+    data_shapes = get_data_shapes(input_size, channels, n_class, n_atlas, batch_size)
+    with tf.name_scope('input_pipeline'):
+        dataset = tf.data.Dataset.from_generator(lambda: ({k: data[k] for k in data_shapes} for data in generator()),
+                                                 output_types=get_data_types(),
+                                                 output_shapes={k: tf.TensorShape(v) for k, v in data_shapes.items()})
+        if repeats > 1:
+            dataset = dataset.flat_map(lambda data: tf.data.Dataset.from_tensors(data).repeat(repeats))
+        if aug_kwargs is not None:
+            dataset = dataset.map(lambda data: augment_data(data, **aug_kwargs),
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if device is None:
+            dataset = dataset.prefetch(buffer_size)
+        else:
+            dataset = dataset.apply(tf.data.experimental.prefetch_to_device(device, buffer_size))
+
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        # recorded for the trainer to check that its self iterations consume exactly the repeated batches
+        setattr(iterator, 'repeats', repeats)
+        return iterator
+
+
+def _maybe_jit_scope(enabled):
+    """
+    Get an XLA jit scope if enabled, otherwise an empty context.
+
+    :param enabled: Whether to compile the ops created within the scope with XLA.
+    :return: A context manager.
+    """
+    stack = contextlib.ExitStack()
+    if enabled:
+        stack.enter_context(tf.xla.experimental.jit_scope())
+    return stack
@@ -142,7 +142,7 @@ def save_prediction_png(image, label, pred, save_path, data_provider, **kwargs):
     abs_pred_path = os.path.abspath(save_path)
     if not os.path.exists(abs_pred_path):
         logging.info("Allocating '{:}'".format(abs_pred_path))
-        os.makedirs(abs_pred_path)
+        os.makedirs(abs_pred_path, exist_ok=True)
 
     if save_name is None:
         name_index = kwargs.pop("name_index")
@@ -263,6 +263,39 @@ def save_prediction_nii(pred, save_path, data_provider, data_type='image', **kwa
         nib.save(img, os.path.join(save_path, save_prefix + '_'.join([save_name, save_suffix])))
 
 
+def save_ddfs_nii(ddfs, save_path, save_names, **kwargs):
+    """
+    Save the dense displacement fields of all atlases, one nifty image for each atlas.
+    The zero z-component is appended to the stacked fields at once, and the output directory is allocated only once.
+
+    :param ddfs: The displacement fields of shape [*vol_shape, n_atlas, 2].
+    :param save_path: where to save the validation/test predictions, has the form of 'directory'
+    :param save_names: The saved filenames of the atlases, of length n_atlas.
+    :param kwargs: affine - The affine matrix array;
+                   header - The header that contains the image metadata;
+                   save_prefix - The prefix of the saved filename;
+                   save_suffix - The suffix of the saved filename
+    """
+    affine = kwargs.pop("affine", np.eye(4))
+    header = kwargs.pop("header", None)
+    save_prefix = kwargs.pop("save_prefix", '')
+    save_suffix = kwargs.pop("save_suffix", 'vector.nii.gz')
+    save_dtype = kwargs.pop("save_dtype", np.float32)
+
+    abs_pred_path = os.path.abspath(save_path)
+    if not os.path.exists(abs_pred_path):
+        logging.info("Allocating '{:}'".format(abs_pred_path))
+        os.makedirs(abs_pred_path, exist_ok=True)
+
+    if ddfs.shape[-1] <= 2:
+        ddfs = np.concatenate([ddfs, np.zeros(ddfs.shape[:-1] + (3 - ddfs.shape[-1],), dtype=ddfs.dtype)], axis=-1)
+    ddfs = ddfs.astype(save_dtype)
+
+    for k, save_name in enumerate(save_names):
+        img = nib.Nifti1Image(ddfs[..., k:k + 1, :], affine=affine, header=header)
+        nib.save(img, os.path.join(save_path, save_prefix + '_'.join([save_name, save_suffix])))
+
+
 def save_prediction_numpy(predictions, save_path, image_names, image_suffix, save_prefix):
     """
     Save the predictions into numpy array.
@@ -507,6 +540,38 @@ def pad_to_shape_label(label, shape):
     return np.stack(class_pred, axis=-1)
 
 
+def merge_atlas_axis(tensor):
+    """
+    Fold the atlas axis into the batch axis, so that all atlases can be processed by a single batched op.
+
+    :param tensor: A tensor of shape [n_batch, *vol_shape, n_atlas, channels].
+    :return: A tensor of shape [n_batch * n_atlas, *vol_shape, channels].
+    """
+    with tf.name_scope('merge_atlas_axis'):
+        shape = tensor.get_shape().as_list()
+        if shape[-2] == 1:
+            # a single atlas needs no transposition
+            return tf.squeeze(tensor, axis=-2)
+        tensor = tf.transpose(tensor, [0, len(shape) - 2, *range(1, len(shape) - 2), len(shape) - 1])
+        return tf.reshape(tensor, [-1, *shape[1:-2], shape[-1]])
+
+
+def split_atlas_axis(tensor, n_atlas):
+    """
+    Inverse of merge_atlas_axis, restore the atlas axis from the batch axis.
+
+    :param tensor: A tensor of shape [n_batch * n_atlas, *vol_shape, channels].
+    :param n_atlas: The number of atlases.
+    :return: A tensor of shape [n_batch, *vol_shape, n_atlas, channels].
+    """
+    with tf.name_scope('split_atlas_axis'):
+        if n_atlas == 1:
+            return tf.expand_dims(tensor, axis=-2)
+        shape = tensor.get_shape().as_list()
+        tensor = tf.reshape(tensor, [-1, n_atlas, *shape[1:]])
+        return tf.transpose(tensor, [0, *range(2, len(shape)), 1, len(shape)])
+
+
 ###################################################
 # functions for label fusion
 ###################################################
@@ -654,6 +719,41 @@ def interpn(vol, loc, interp_method='linear'):
     return interp_vol
 
 
+def resample(vol, loc):
+    """
+    Batched bilinear interpolation of 2-D volumes using the native resampler kernel of tf.contrib, which samples the
+    whole batch in one pass.
+
+    The sampling locations are clamped to the volume boundary so that the results are consistent with interpn.
+
+    :param vol: volumes of shape [n_batch, *vol_shape, nb_features]
+    :param loc: sampling locations in 'ij' indexing, of shape [n_batch, *new_vol_shape, 2]
+    :return: the interpolated volumes of shape [n_batch, *new_vol_shape, nb_features]
+    """
+    with tf.name_scope('resample'):
+        max_loc = tf.constant([d - 1 for d in vol.get_shape().as_list()[1:-1]], dtype=tf.float32)
+        loc = tf.minimum(tf.maximum(loc, 0.), max_loc)
+        # the resampler takes locations in (x, y) order, i.e. reversed from 'ij' indexing
+        return tf.contrib.resampler.resampler(vol, tf.reverse(loc, axis=[-1]))
+
+
+def warp(vol, ddf, grid=None):
+    """
+    Warp volumes with dense displacement fields by a single pass of bilinear resampling, which avoids building the
+    sampling grid of the SpatialTransformer layer on every call.
+
+    :param vol: volumes of shape [n_batch, *vol_shape, nb_features]
+    :param ddf: dense displacement fields in 'ij' indexing, of shape [n_batch, *vol_shape, 2]
+    :param grid: (optional) the identity sampling grid of shape [*vol_shape, 2]
+    :return: the warped volumes of shape [n_batch, *vol_shape, nb_features]
+    """
+    with tf.name_scope('warp'):
+        if grid is None:
+            grid = tf.constant(get_reference_grid_numpy(ddf.get_shape().as_list()[1:-1]), dtype=tf.float32,
+                               name='identity_grid')
+        return resample(vol, grid + ddf)
+
+
 def resize(vol, zoom_factor, interp_method='linear'):
     """
     if zoom_factor is a list, it will determine the ndims, in which case vol has to be of length ndims of ndims + 1
@@ -795,24 +895,35 @@ def integrate_vec(vec, int_steps=1, **kwargs):
     """
     Integrate stationary vector fields by scaling and squaring.
 
+    The identity sampling grid is built once as a constant and reused across all squaring steps. All atlases are
+    integrated together with the atlas axis folded into the batch axis, so that each squaring step is a single
+    bilinear resampling followed by an addition, run in a tf.while_loop.
+
     :param vec: the vector fields to be integrated, of shape [n_batch, *vol_shape, n_atlas, vol_dim]
     :param int_steps: number of integration times= 2**int_steps
-    :return:
+    :param kwargs: grid - (optional) the identity sampling grid of shape [*vol_shape, vol_dim]
+    :return: the integrated vector fields of shape [n_batch, *vol_shape, n_atlas, vol_dim]
     """
-    def integrate(vec):
-        """
-        :param vec: vector fields of shape [*vol_shape, n_atlas, vol_dim]
-        :return:
-        """
+    with tf.name_scope('integrate_vec'):
+        vol_shape = vec.get_shape().as_list()[1:-2]
         n_atlas = vec.get_shape().as_list()[-2]
-        int_vec = [vec[..., i, :] for i in range(n_atlas)]
-        for i in range(n_atlas):
-            for _ in range(int_steps):
-                int_vec[i] += transform(int_vec[i], int_vec[i])
-        return tf.stack(int_vec, axis=-2)
+        grid = kwargs.pop('grid', None)
+        if grid is None:
+            grid = tf.constant(get_reference_grid_numpy(vol_shape), dtype=tf.float32, name='identity_grid')
+
+        def squaring(i, v):
+            """
+            :param v: vector fields of shape [n_batch * n_atlas, *vol_shape, vol_dim]
+            :return: the self-composed vector fields
+            """
+            return i + 1, v + resample(v, grid + v)
+
+        # with tf.control_dependencies([tf.assert_less(tf.reduce_max(vec), eps)]):
+        int_vec = merge_atlas_axis(vec)
+        _, int_vec = tf.while_loop(lambda i, v: i < int_steps, squaring, [tf.constant(0), int_vec],
+                                   back_prop=True, name='scaling_and_squaring')
 
-    # with tf.control_dependencies([tf.assert_less(tf.reduce_max(vec), eps)]):
-    return tf.map_fn(integrate, vec, dtype=tf.float32)
+        return split_atlas_axis(int_vec, n_atlas)
 
 
 def volshape_to_ndgrid(volshape, **kwargs):
@@ -1069,14 +1180,17 @@ def get_prob_from_label(label, sigma=1., **kwargs):
 
     :param label: One-hot label of shape [n_batch, *vol_shape, n_class]
     :param sigma: The isotropic standard deviation of the Gaussian filter.
+    :param kwargs: dtype - (optional) the precision of the Gaussian filtering in 'tf' mode, e.g. tf.float16 to halve
+        the memory traffic of the convolutions; normalization is always performed in float32.
     :return: Probability map of shape [n_batch, *vol_shape, n_class]
     """
     eps = kwargs.pop('eps', math.exp(-3**2/2))
     mode = kwargs.pop('mode', 'tf')
     if mode == 'tf':
+        dtype = tf.as_dtype(kwargs.pop('dtype', tf.float32))
         with tf.name_scope('get_prob_from_label'):
-            blur = separable_filter2d(label, gauss_kernel1d(sigma))
-            prob = get_normalized_prob(blur, eps=eps)
+            blur = separable_filter2d(tf.cast(label, dtype), gauss_kernel1d(sigma))
+            prob = get_normalized_prob(tf.cast(blur, tf.float32), eps=eps)
     elif mode == 'np':
         blur = separable_filter2d(label, gauss_kernel1d(sigma), mode='np')
         prob = get_normalized_prob(blur, mode='np', eps=eps)
@@ -1085,6 +1199,51 @@ def get_prob_from_label(label, sigma=1., **kwargs):
     return prob
 
 
+def get_multi_scale_prob_from_label(label, sigmas, **kwargs):
+    """
+    Produce probability maps of multiple scales from one-hot labels, where the Gaussian filters of the scales with the
+    same kernel size are applied in a single pass of separable depth-wise convolutions, with the kernels stacked along
+    the channel axis.
+
+    :param label: One-hot label of shape [n_batch, *vol_shape, n_class]
+    :param sigmas: The isotropic standard deviations of the Gaussian filters, one for each scale.
+    :param kwargs: dtype - (optional) the precision of the Gaussian filtering
+    :return: Probability maps of shape [n_batch, *vol_shape, n_class, n_scale]
+    """
+    eps = kwargs.pop('eps', math.exp(-3**2/2))
+    dtype = tf.as_dtype(kwargs.pop('dtype', tf.float32))
+    with tf.name_scope('get_multi_scale_prob_from_label'):
+        vol_shape = label.get_shape().as_list()[1:-1]
+        n_class = label.get_shape().as_list()[-1]
+        # a zero sigma gives the identity kernel
+        kernels = [np.ones(1) if sigma == 0 else gauss_kernel1d(sigma) for sigma in sigmas]
+
+        strides = [1, 1, 1, 1]
+        # the scales are grouped by kernel size, so that the small kernels are not zero-padded to the largest one
+        blurs, order = [], []
+        for size in sorted(set(len(k) for k in kernels)):
+            scales = [i for i, k in enumerate(kernels) if len(k) == size]
+            group = np.stack([kernels[i] for i in scales])  # [n_group, size]
+            n_group = len(scales)
+            # the first pass spreads each class channel into n_group channels, ordered as class * n_group + scale
+            kernel_x = tf.constant(np.tile(np.reshape(group.T, [-1, 1, 1, n_group]), [1, 1, n_class, 1]),
+                                   dtype=dtype)
+            kernel_y = tf.constant(np.reshape(np.tile(group, [n_class, 1]).T, [1, -1, n_class * n_group, 1]),
+                                   dtype=dtype)
+            blur = tf.nn.depthwise_conv2d(tf.nn.depthwise_conv2d(tf.cast(label, dtype), kernel_x, strides, "SAME"),
+                                          kernel_y, strides, "SAME")
+            blurs.append(tf.reshape(tf.cast(blur, tf.float32), [-1, *vol_shape, n_class, n_group]))
+            order.extend(scales)
+
+        blur = blurs[0] if len(blurs) == 1 else tf.concat(blurs, axis=-1)
+        if order != sorted(order):
+            # restore the order of the scales
+            blur = tf.gather(blur, np.argsort(order), axis=-1)
+
+        prob = tf.clip_by_value(blur, eps, 1-eps)
+        return tf.divide(prob, tf.reduce_sum(prob, axis=-2, keepdims=True), name='normalized_prob')
+
+
 def get_atlases_prob_from_label(atlases_label, sigma=1., **kwargs):
     """
     Produce probabilistic atlases using isotropic Gaussian filters.
@@ -1100,8 +1259,8 @@ def get_atlases_prob_from_label(atlases_label, sigma=1., **kwargs):
     if mode == 'tf':
         with tf.name_scope('get_atlases_prob'):
             n_atlas = atlases_label.get_shape().as_list()[-2]
-            atlases_prob = tf.stack([get_prob_from_label(atlases_label[..., i, :], sigma, eps=eps)
-                                     for i in range(n_atlas)], axis=-2, name='atlases_prob')
+            atlases_prob = split_atlas_axis(get_prob_from_label(merge_atlas_axis(atlases_label), sigma, eps=eps),
+                                            n_atlas)
 
     elif mode == 'np':
         n_atlas = atlases_label.shape[-2]
@@ -1200,13 +1359,14 @@ def separable_filter2d(vol, kernel, mode='tf'):
     if np.all(kernel == 0):
         return vol
     if mode == 'tf':
-        kernel = tf.constant(kernel, dtype=tf.float32)
+        kernel = tf.constant(kernel, dtype=vol.dtype)
         channels = vol.get_shape().as_list()[-1]
         strides = [1, 1, 1, 1]
-        return tf.concat([tf.nn.conv2d(tf.nn.conv2d(
-            vol[..., i, None],
-            tf.reshape(kernel, [-1, 1, 1, 1]), strides, "SAME"),
-            tf.reshape(kernel, [1, -1, 1, 1]), strides, "SAME") for i in range(channels)], axis=-1)
+        # filter all channels at once by depth-wise convolution with the kernel shared across channels
+        kernel_x = tf.tile(tf.reshape(kernel, [-1, 1, 1, 1]), [1, 1, channels, 1])
+        kernel_y = tf.tile(tf.reshape(kernel, [1, -1, 1, 1]), [1, 1, channels, 1])
+        return tf.nn.depthwise_conv2d(tf.nn.depthwise_conv2d(vol, kernel_x, strides, "SAME"),
+                                      kernel_y, strides, "SAME")
     elif mode == 'np':
         return signal.convolve(signal.convolve(vol, np.reshape(kernel, [1, -1, 1, 1]), 'same'),
                                np.reshape(kernel, [1, 1, -1, 1]), 'same')
@@ -1271,12 +1431,9 @@ def get_reference_grid_numpy(grid_size):
     Get coordinate matrices from grid size.
 
     :param grid_size: The size of the mesh grid.
-    :return: An array of shape [*vol_shape, 3], representing the coordinates.
+    :return: An array of shape [*vol_shape, len(vol_shape)], representing the coordinates.
     """
-    return np.stack(np.meshgrid([i for i in range(grid_size[0])],
-                                [j for j in range(grid_size[1])],
-                                [k for k in range(grid_size[2])],
-                                indexing='ij'), axis=3)
+    return np.stack(np.meshgrid(*[range(d) for d in grid_size], indexing='ij'), axis=-1)
 
 
 def get_reference_grid_by_boundary(begins, ends):
@@ -30,6 +30,9 @@ t = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 config = tf.ConfigProto(allow_soft_placement=True)
 config.gpu_options.allow_growth = True
+# use the graph rewrites of training, and trade recomputation for a lower peak memory at prediction
+config.graph_options.rewrite_options.CopyFrom(model.config.graph_options.rewrite_options)
+config.graph_options.rewrite_options.memory_optimization = model.rewriter_config_pb2.RewriterConfig.HEURISTICS
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -260,6 +263,7 @@ if __name__ == '__main__':
                                      num_down_blocks=4,
                                      dropout_type=args.dropout_type,
                                      ddf_levels=args.ddf_levels,
+                                     prefetch_device=None if args.cuda_device == -1 else '/gpu:0',
                                      gap_filling=args.gap_filling,
                                      num_filling_blocks=args.num_filling_blocks,
                                      cost_kwargs={'cost_name': args.cost_function,
@@ -334,10 +338,8 @@ if __name__ == '__main__':
 
                     # groupwise registration for each atlases pairs
                     for comb_a_names in comb_atlas_names:
-                        # store test predictions
-                        warped_atlases_weights = []
-                        warped_atlases_probs = []
-
+                        # collect test data
+                        comb_test_data = []
                         for a_names in comb_a_names:
                             logging.info("Target: %s, Atlases: %s" % (os.path.basename(slice_name),
                                                                       [os.path.basename(a_name) for a_name in a_names]))
@@ -346,12 +348,11 @@ if __name__ == '__main__':
 
                             # get test data
                             test_data = test_data_provider[idx]
+                            comb_test_data.append(test_data)
 
-                            # predict
-                            warped_atlases_prob, warped_atlases_weight = net.predict_scale(sess, test_data, args.dropout)
-
-                            warped_atlases_weights.append(warped_atlases_weight)
-                            warped_atlases_probs.append(warped_atlases_prob)
+                        # predict all atlases pairs in a row, with the input pipeline prefetching the next pair
+                        warped_atlases_probs, warped_atlases_weights = zip(*net.predict_scale(sess, comb_test_data,
+                                                                                              args.dropout))
 
                         # get fusion predictor
                         slice_predictor = utils_2d.get_segmentation(
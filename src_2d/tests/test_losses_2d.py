@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the loss modules.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import utils_2d
+from core.losses_2d import LocalDisplacementEnergy
+
+
+def _count_negative_jacobians(ddf, energy_ddf=None):
+    """
+    Build the bending energy and negative Jacobian graph on atlas-merged ddfs, as in the trainer, and evaluate it.
+
+    :param ddf: The displacement fields of shape [n_batch, nx, ny, n_atlas, 2].
+    :param energy_ddf: (Optional) other displacement fields of the same shape for the bending energy, built first.
+    :return: The number of voxels of non-positive Jacobian determinants per sample.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        BendingEnergy = LocalDisplacementEnergy(energy_type='bending')
+        merged_ddf = utils_2d.merge_atlas_axis(tf.constant(ddf, dtype=tf.float32))
+        if energy_ddf is None:
+            energy_merged_ddf = merged_ddf
+        else:
+            energy_merged_ddf = utils_2d.merge_atlas_axis(tf.constant(energy_ddf, dtype=tf.float32))
+        BendingEnergy.compute_displacement_energy(energy_merged_ddf, 1.)
+        num_neg_jacob = BendingEnergy.compute_negative_jacobian_number(merged_ddf, ddf.shape[-2])
+        with tf.Session(graph=graph) as sess:
+            return sess.run(num_neg_jacob)
+
+
+def test_negative_jacobian_number_multi_atlas():
+    n_batch, nx, ny, n_atlas = 2, 8, 8, 2
+    x = np.arange(nx, dtype=np.float32).reshape(1, nx, 1, 1)
+
+    assert _count_negative_jacobians(np.zeros([n_batch, nx, ny, n_atlas, 2], dtype=np.float32)) == 0
+
+    # a flip along x in both atlases folds every interior voxel
+    ddf = np.zeros([n_batch, nx, ny, n_atlas, 2], dtype=np.float32)
+    ddf[..., 0] = -2 * x
+    assert _count_negative_jacobians(ddf) == (nx - 2) * (ny - 2)
+
+    # the determinants are averaged over atlases before counting, here -1 and 2
+    ddf[..., 1, 0] = x[..., 0]
+    assert _count_negative_jacobians(ddf) == 0
+
+
+def test_negative_jacobian_number_other_ddf():
+    n_batch, nx, ny, n_atlas = 2, 8, 8, 2
+    x = np.arange(nx, dtype=np.float32).reshape(1, nx, 1, 1)
+    folded_ddf = np.zeros([n_batch, nx, ny, n_atlas, 2], dtype=np.float32)
+    folded_ddf[..., 0] = -2 * x
+
+    # the gradients cached by the bending energy of another ddf must not be reused
+    assert _count_negative_jacobians(folded_ddf, energy_ddf=np.zeros_like(folded_ddf)) == (nx - 2) * (ny - 2)
+    assert _count_negative_jacobians(np.zeros_like(folded_ddf), energy_ddf=folded_ddf) == 0
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the image re-sampling functions.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import utils_2d
+from core.layers_2d import SpatialTransformer
+
+
+def _run(build_fn, *arrays):
+    """
+    Build a graph on constant inputs and evaluate it.
+
+    :param build_fn: A function mapping the input tensors to the output tensor.
+    :param arrays: The input arrays.
+    :return: The output array.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        output = build_fn(*[tf.constant(a, dtype=tf.float32) for a in arrays])
+        with tf.Session(graph=graph) as sess:
+            return sess.run(output)
+
+
+def _boundary_ddf(n_batch, nx, ny):
+    """
+    Get displacement fields that sample exactly on, just inside and beyond the volume boundaries.
+    """
+    grid = utils_2d.get_reference_grid_numpy([nx, ny]).astype(np.float32)
+    targets = [np.zeros([nx, ny, 2]), np.full([nx, ny, 2], [nx - 1, ny - 1]), np.full([nx, ny, 2], [nx - 1.25, 0.25]),
+               np.full([nx, ny, 2], [-3., ny + 2.5]), grid * 1.5 - 2]
+    return np.stack([targets[k % len(targets)] - grid for k in range(n_batch)]).astype(np.float32)
+
+
+@pytest.mark.parametrize('scale', [0.5, 4., 'boundary'])
+def test_warp_matches_spatial_transformer(scale):
+    rng = np.random.RandomState(0)
+    n_batch, nx, ny = 5, 16, 12
+    vol = rng.rand(n_batch, nx, ny, 3).astype(np.float32)
+    if scale == 'boundary':
+        ddf = _boundary_ddf(n_batch, nx, ny)
+    else:
+        ddf = (scale * rng.randn(n_batch, nx, ny, 2)).astype(np.float32)
+
+    expected = _run(lambda v, d: SpatialTransformer(interp_method='linear')([v, d]), vol, ddf)
+    np.testing.assert_allclose(_run(utils_2d.warp, vol, ddf), expected, rtol=1e-5, atol=1e-5)
+
+
+def _integrate_vec_per_atlas(vec, int_steps):
+    """
+    Integrate the vector fields of each atlas separately with transform, as the loop integrate_vec replaces.
+    """
+    def integrate(v):
+        n_atlas = v.get_shape().as_list()[-2]
+        int_vec = [v[..., i, :] for i in range(n_atlas)]
+        for i in range(n_atlas):
+            for _ in range(int_steps):
+                int_vec[i] += utils_2d.transform(int_vec[i], int_vec[i])
+        return tf.stack(int_vec, axis=-2)
+
+    return tf.map_fn(integrate, vec, dtype=tf.float32)
+
+
+@pytest.mark.parametrize('scale', [0.5, 3.])
+def test_integrate_vec_matches_per_atlas_loop(scale):
+    rng = np.random.RandomState(1)
+    n_batch, nx, ny, n_atlas, int_steps = 2, 16, 12, 3, 4
+    # larger velocities push the compositions beyond the volume boundaries
+    vec = (scale * rng.randn(n_batch, nx, ny, n_atlas, 2) / 2 ** int_steps).astype(np.float32)
+
+    expected = _run(lambda v: _integrate_vec_per_atlas(v, int_steps), vec)
+    np.testing.assert_allclose(_run(lambda v: utils_2d.integrate_vec(v, int_steps), vec), expected,
+                               rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('sigmas', [(2., 0., 1., 0.5, 2.2), (1.5,)])
+def test_multi_scale_prob_matches_single_scales(sigmas):
+    rng = np.random.RandomState(2)
+    n_class = 4
+    label = np.eye(n_class, dtype=np.float32)[rng.randint(n_class, size=(2, 20, 16))]
+
+    expected = _run(lambda l: tf.stack([utils_2d.get_prob_from_label(l, sigma) for sigma in sigmas], axis=-1), label)
+    np.testing.assert_allclose(_run(lambda l: utils_2d.get_multi_scale_prob_from_label(l, sigmas), label), expected,
+                               rtol=1e-5, atol=1e-6)
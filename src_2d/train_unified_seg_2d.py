@@ -19,6 +19,7 @@ import os
 import logging
 from datetime import datetime
 import tensorflow as tf
+from torch.utils.data import DataLoader
 # import math
 
 t = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -130,6 +131,10 @@ parser.add_argument('--prob_method', default='use_mask', type=str, choices=['use
                     help='whether to use certain method when computing the loss function')
 parser.add_argument('--prob_sigma', default=(1, ), type=float, nargs='+',
                     help='the standard deviation of the Gaussian filter for multi-scale probability maps')
+parser.add_argument('--prob_dtype', default='float32', type=str, choices=['float32', 'float16'],
+                    help='the precision of the Gaussian filtering when producing probability maps from labels')
+parser.add_argument('--jit_loss', default=False, action='store_true',
+                    help='whether to compile the loss subgraph with XLA')
 parser.add_argument('--prob_threshold', default=(0.015, 0.985), type=float, nargs='+',
                     help='probability threshold to compute mask when using label consistency loss')
 parser.add_argument('--regularizer', default=(None, 'bending_energy'), nargs='+',
@@ -145,6 +150,12 @@ parser.add_argument('--bending_energy_increment_rate', default=1., type=float,
 parser.add_argument('--optimizer_name', default='adam', type=str,
                     choices=['momentum', 'adam', 'sgd', 'rmsprop', 'adam-clr', 'radam', 'adabound'],
                     help='type of the optimizer to use (momentum, adam, sgd or rmsprop)')
+parser.add_argument('--lr_schedule', default='exponential', type=str, choices=['exponential', 'piecewise', 'cosine'],
+                    help='learning rate schedule of the momentum/sgd optimizers')
+parser.add_argument('--jit_optimizer', default=False, action='store_true',
+                    help='whether to compile the optimizer and bending energy subgraphs with XLA')
+parser.add_argument('--use_fp16', default=False, action='store_true',
+                    help='whether to train in mixed precision with dynamic loss scaling')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='how many sub-processes to use for data loading')
 parser.add_argument('--learning_rate', default=1e-5, type=float,
@@ -176,6 +187,8 @@ parser.add_argument('--display_step', default=500, type=int,
 parser.add_argument('--validation_step', default=None, type=int, help='number of steps till each validation')
 parser.add_argument('--prediction_path', default='validation_prediction', type=str,
                     help='path where to save predictions on each epoch')
+parser.add_argument('--ddf_save_suffix', default='vector.nii.gz', type=str, choices=['vector.nii.gz', 'vector.nii'],
+                    help='suffix of the validation displacement fields, vector.nii skips the gzip compression')
 
 # validation data setups
 parser.add_argument('--test_target_search_path', type=str,
@@ -283,7 +296,23 @@ if __name__ == '__main__':
                                                            normalization_method=args.normalization_method,
                                                            logger=logger)
 
+        # data augmentation settings
+        aug_kwargs = {'affine_augment': args.affine_augment,
+                      'rot_std': args.rot_std,
+                      'scl_std': args.scl_std,
+                      'tra_std': args.tra_std,
+                      'she_std': args.she_std}
+
         with tf.Graph().as_default():
+            # training input pipeline, which loads the data with multiple workers, augments them on the CPU and
+            # prefetches them to the device in the background, with each batch repeated for the self iterations
+            train_data_loader = DataLoader(train_data_provider, batch_size=args.batch_size, shuffle=True,
+                                           num_workers=args.num_workers, collate_fn=train_data_provider.collate_fn)
+            train_data_iterator = model.get_data_iterator(lambda: train_data_loader, args.input_size,
+                                                          args.train_channels, args.train_n_class, args.num_atlases,
+                                                          device=None if args.cuda_device == -1 else '/gpu:0',
+                                                          aug_kwargs=aug_kwargs, repeats=args.self_iters)
+
             # establish model
             net = model.UnifiedMultiAtlasSegNet(# basic model setups
                                                 input_size=args.input_size,
@@ -307,21 +336,22 @@ if __name__ == '__main__':
                                                              'prior_prob': args.prior_prob,
                                                              'prob_method': args.prob_method,
                                                              'prob_sigma': args.prob_sigma,
+                                                             'prob_dtype': args.prob_dtype,
+                                                             'jit_loss': args.jit_loss,
                                                              'prob_threshold': args.prob_threshold,
                                                              'regularizer': args.regularizer,
                                                              'regularization_coefficient': args.regularization_coefficient,
                                                              'bending_energy_increment_rate': args.bending_energy_increment_rate},
                                                 # data augmentation settings
-                                                aug_kwargs={'affine_augment': args.affine_augment,
-                                                            'rot_std': args.rot_std,
-                                                            'scl_std': args.scl_std,
-                                                            'tra_std': args.tra_std,
-                                                            'she_std': args.she_std},
+                                                aug_kwargs=aug_kwargs,
+                                                input_tensors=train_data_iterator.get_next(),
                                                 logger=logger)
 
             # trainer initialization
             trainer = model.Trainer(net, batch_size=args.batch_size, optimizer_name=args.optimizer_name,
-                                    learning_rate=args.learning_rate, num_workers=args.num_workers)
+                                    learning_rate=args.learning_rate, num_workers=args.num_workers,
+                                    data_iterator=train_data_iterator, jit_optimizer=args.jit_optimizer,
+                                    lr_schedule=args.lr_schedule, use_fp16=args.use_fp16)
 
             # train network
             # Todo: check the restore model part
@@ -336,6 +366,7 @@ if __name__ == '__main__':
                           validation_step=args.validation_step,
                           self_iters=args.self_iters,
                           prediction_path=os.path.join(save_path, 'trial_%s' % i, args.prediction_path),
+                          ddf_save_suffix=args.ddf_save_suffix,
                           restore=args.restore,
                           restore_model_path=args.restore_model_path,
                           latest_filename=args.latest_filename)